@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load the log files of Nagios or Shinken (nagios.log, archives/nagios-MM-DD-YYYY-HH.log,
+plain or gzipped) in the datafiles of the logstore-sqlite module, eg. when migrating
+from Nagios or from an older livestatus setup:
+
+    bulk_load.py /var/log/shinken/livelogs.db /var/log/nagios/archives/nagios-*.log
+
+The logs of the past days are stored in the archives of their days, the logs of the
+current day in the current datafile. Stop the broker while the logs are loaded.
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+# The modules directory of Shinken, this module is one of its directories
+MODULE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] database_file log_file [log_file ...]")
+    parser.add_option('-a', '--archive-path', dest='archive_path',
+                      help="Directory of the archives, defaults to the archives directory of the database file")
+    parser.add_option('-p', '--processes', dest='processes', type='int', default=0,
+                      help="Number of processes parsing the log files, defaults to one per cpu")
+    parser.add_option('-s', '--storage-schema', dest='storage_schema', default='plain',
+                      help="Storage schema of the new datafiles: plain or compact")
+    parser.add_option('-i', '--index-profile', dest='index_profile', default='standard',
+                      help="Indexes of the logs: minimal, standard, full or a list like host_name+time,class+time")
+    parser.add_option('-f', '--fulltext-index', dest='fulltext_index', action='store_true', default=False,
+                      help="Create the full-text index of the message and plugin_output columns")
+    parser.add_option('--partition-hours', dest='partition_hours', default='0',
+                      help="Partitions of the days of the archives, in hours, as the partition_hours parameter")
+    opts, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error("a database file and some log files are required")
+
+    from shinken.modulesctx import modulesctx
+    from shinken.objects.module import Module
+
+    modulesctx.set_modulesdir(os.path.dirname(MODULE_PATH))
+    logstore_sqlite = modulesctx.get_module(os.path.basename(MODULE_PATH))
+
+    modconf = Module({
+        'module_name': 'LogStore',
+        'module_type': 'logstore_sqlite',
+        'database_file': args[0],
+        'archive_path': opts.archive_path,
+        'vacuum_mode': 'none',
+        'performance_profile': 'bulk-load',
+        'storage_schema': opts.storage_schema,
+        'index_profile': opts.index_profile,
+        'fulltext_index': '1' if opts.fulltext_index else '0',
+        'partition_hours': opts.partition_hours,
+    })
+    store = logstore_sqlite.LiveStatusLogStoreSqlite(modconf)
+    store.open()
+    store.prepare_log_db_table()
+    start = time.time()
+    try:
+        count = store.log_db_bulk_load(args[1:], opts.processes)
+    finally:
+        store.close()
+    print("%d logs loaded in %.1f seconds" % (count, time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
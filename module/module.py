@@ -31,11 +31,25 @@ It is one possibility for an exchangeable storage for log broks
 
 import os
 import time
+import bisect
 import datetime
+import gzip
+import multiprocessing
 import re
+import shutil
 import sqlite3
+import sys
+import tempfile
+import threading
 
+from collections import OrderedDict
 from functools import partial
+from itertools import groupby
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
 
 from shinken.log import logger
 from shinken.modulesctx import modulesctx
@@ -46,6 +60,8 @@ from shinken.objects.module import Module
 livestatus_broker = modulesctx.get_module('livestatus')
 LiveStatusStack = livestatus_broker.LiveStatusStack
 LOGCLASS_INVALID = livestatus_broker.LOGCLASS_INVALID
+LOGCLASS_ALERT = getattr(livestatus_broker, 'LOGCLASS_ALERT', 1)
+LOGCLASS_STATE = getattr(livestatus_broker, 'LOGCLASS_STATE', 6)
 Logline = livestatus_broker.Logline
 
 
@@ -82,14 +98,418 @@ def row_factory(cursor, row):
     return Logline(sqlite_cursor=cursor.description, sqlite_row=row)
 
 
+def tuple_row_factory(cursor, row):
+    """Handler for the sqlite fetch method which keeps the rows as tuples."""
+    return row
+
+
+class LiveStatusLogRowFactory(object):
+    """
+    Handler for the sqlite fetch method which returns light LiveStatusLogRow rows.
+
+    The positions of the columns are computed from the cursor description of the
+    first row, a factory must thus be used for one statement only.
+    """
+
+    def __init__(self):
+        self.description = None
+        self.positions = None
+
+    def __call__(self, cursor, row):
+        if self.positions is None:
+            self.description = cursor.description
+            self.positions = dict(('logclass' if column[0] == 'class' else column[0], position)
+                                  for position, column in enumerate(self.description))
+        return LiveStatusLogRow(self, row)
+
+
+class LiveStatusLogRow(object):
+    """
+    A log row which keeps the fetched sqlite row instead of building a Logline.
+
+    The columns of the logs table are read from the row, any other attribute is
+    read from a full Logline which is only built when it is needed, usually by
+    the output of the rows which passed the filters.
+    """
+    __slots__ = ('_factory', '_row', '_datamgr', '_logline')
+
+    def __init__(self, factory, row):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_row', row)
+        object.__setattr__(self, '_datamgr', None)
+        object.__setattr__(self, '_logline', None)
+
+    def __getattr__(self, name):
+        position = self._factory.positions.get(name)
+        if position is not None:
+            return self._row[position]
+        return getattr(self.get_logline(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get_logline(), name, value)
+
+    def __repr__(self):
+        return '<LiveStatusLogRow %r>' % (self._row,)
+
+    def fill(self, datamgr):
+        """The full Logline is filled with the datamgr objects when it is built"""
+        object.__setattr__(self, '_datamgr', datamgr)
+        return self
+
+    def get_logline(self):
+        if self._logline is None:
+            logline = Logline(sqlite_cursor=self._factory.description, sqlite_row=self._row)
+            if self._datamgr is not None:
+                logline = logline.fill(self._datamgr) or logline
+            object.__setattr__(self, '_logline', logline)
+        return self._logline
+
+
+def merge_stats(function, merged, value):
+    """Merge two partial results of a stats function, None being the result of no rows."""
+    if merged is None:
+        return value
+    if value is None:
+        return merged
+    return STATS_FUNCTIONS[function](merged, value)
+
+
 class LiveStatusLogStoreError(Exception):
     pass
 
 
+class LiveStatusCachedResult(object):
+    """
+    The rows of a query kept in the result cache. It is the row factory of the query,
+    which keeps the fetched rows as tuples, and the cursor of the row factory of the
+    cached rows, with the same description.
+    """
+
+    def __init__(self, max_size):
+        self.description = None
+        self.chunks = []
+        self.size = 0
+        self.max_size = max_size
+
+    def __call__(self, cursor, row):
+        if self.description is None:
+            self.description = cursor.description
+        return row
+
+    def add(self, rows):
+        """Keep a chunk of fetched rows, until the result is too large to be cached"""
+        if self.size > self.max_size:
+            return
+        self.size += sum([sys.getsizeof(row) + sum([sys.getsizeof(value) for value in row]) for row in rows])
+        if self.size > self.max_size:
+            self.chunks = []
+        else:
+            self.chunks.append(rows)
+
+    def fetch(self, a_row_factory):
+        """Yields the cached rows chunk per chunk, as the query would"""
+        for rows in self.chunks:
+            yield [a_row_factory(self, row) for row in rows]
+
+
+class LiveStatusLogResultCache(object):
+    """
+    LRU cache of the results of the archive queries, bounded by a number of results
+    and a memory size. The keys contain the mtime and the size of the archives: the
+    results of a modified archive are not found anymore and are evicted in time.
+    """
+
+    def __init__(self, max_entries, max_memory):
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        # key -> LiveStatusCachedResult, the least recently used first
+        self.entries = OrderedDict()
+        self.memory = 0
+
+    def get(self, key):
+        cached = self.entries.pop(key, None)
+        if cached is not None:
+            self.entries[key] = cached
+        return cached
+
+    def put(self, key, cached):
+        if cached.size > self.max_memory:
+            return
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.memory -= previous.size
+        self.entries[key] = cached
+        self.memory += cached.size
+        while len(self.entries) > self.max_entries or self.memory > self.max_memory:
+            _, evicted = self.entries.popitem(last=False)
+            self.memory -= evicted.size
+
+
+class LiveStatusLogStoreMetrics(object):
+    """
+    Counters and latency histograms of the store. The latencies are counted in the
+    buckets of METRICS_LATENCY_BUCKETS, the last bucket counts the longer ones.
+    They are also updated by the query workers, a lock protects them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        # name -> [count, sum, max, counts of the buckets]
+        self.histograms = {}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0, 0.0, 0.0, [0] * len(METRICS_BUCKET_LABELS)]
+            histogram[0] += 1
+            histogram[1] += seconds
+            histogram[2] = max(histogram[2], seconds)
+            histogram[3][bisect.bisect_left(METRICS_LATENCY_BUCKETS, seconds)] += 1
+
+    def get(self):
+        """Return a snapshot: the uptime, the counters and the count, sum, max and buckets of the histograms"""
+        with self.lock:
+            return {
+                'uptime': time.time() - self.started,
+                'counters': dict(self.counters),
+                'histograms': dict([(name, {'count': count, 'sum': total, 'max': maximum,
+                                            'buckets': list(zip(METRICS_BUCKET_LABELS, buckets))})
+                                    for name, (count, total, maximum, buckets) in self.histograms.items()]),
+            }
+
+    def measure_iteration(self, items, done, size=None):
+        """
+        Yield the items of an iterable and call done(number of items, time spent to produce
+        them, time since the start) at the end, or when the consumer stops before the end.
+        :param size: function returning the number of items of a chunk of items
+        """
+        start = time.time()
+        spent = 0.0
+        count = 0
+        iterator = iter(items)
+        try:
+            while True:
+                before = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    spent += time.time() - before
+                count += size(item) if size else 1
+                yield item
+        finally:
+            done(count, spent, time.time() - start)
+
+
+class LiveStatusTimedRowFactory(object):
+    """A row factory which measures the time spent in another one, when the metrics are enabled"""
+
+    __slots__ = ('factory', 'spent')
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.spent = 0.0
+
+    def __call__(self, cursor, row):
+        start = time.time()
+        try:
+            return self.factory(cursor, row)
+        finally:
+            self.spent += time.time() - start
+
+
+def format_metrics(metrics, last=None):
+    """Format the counters and the mean latencies of a snapshot of the metrics since a previous one"""
+    last = last or {'uptime': 0.0, 'counters': {}, 'histograms': {}}
+    interval = max(metrics['uptime'] - last['uptime'], 0.001)
+    items = []
+    for name, value in sorted(metrics['counters'].items()):
+        value -= last['counters'].get(name, 0)
+        items.append('%s %d (%.1f/s)' % (name, value, value / interval))
+    for name, histogram in sorted(metrics['histograms'].items()):
+        previous = last['histograms'].get(name, {'count': 0, 'sum': 0.0})
+        count = histogram['count'] - previous['count']
+        if count:
+            items.append('%s %d x %.1f ms' % (name, count, (histogram['sum'] - previous['sum']) * 1000 / count))
+    return ', '.join(items)
+
+
 #############################################################################
 
 DEFAULT_LOGS_AGE = 7
 
+# Columns of the logs table and their types
+LOGS_COLUMN_TYPES = (
+    ('logobject', 'INT'), ('attempt', 'INT'), ('class', 'INT'), ('command_name', 'VARCHAR(64)'),
+    ('comment', 'VARCHAR(256)'), ('contact_name', 'VARCHAR(64)'), ('host_name', 'VARCHAR(64)'),
+    ('lineno', 'INT'), ('message', 'VARCHAR(512)'), ('options', 'VARCHAR(512)'),
+    ('plugin_output', 'VARCHAR(256)'), ('service_description', 'VARCHAR(64)'), ('state', 'INT'),
+    ('state_type', 'VARCHAR(10)'), ('time', 'INT'), ('type', 'VARCHAR(64)'),
+)
+LOGS_COLUMNS = tuple([name for name, _ in LOGS_COLUMN_TYPES])
+LOGS_SELECT_COLUMNS = ', '.join(LOGS_COLUMNS)
+INSERT_LOGS_QUERY = 'INSERT INTO %%s (%s) VALUES (%s)' % (LOGS_SELECT_COLUMNS, ', '.join(['?'] * len(LOGS_COLUMNS)))
+
+# Projection of the queries: these columns are always selected, the columns used by
+# Logline.fill are selected when a current_* attribute is requested
+LOGS_KEY_COLUMNS = ('logobject', 'class', 'lineno', 'time')
+LOGS_FILL_COLUMNS = ('logobject', 'command_name', 'contact_name', 'host_name', 'service_description')
+
+# The sql filters with these operators select exactly the rows matched by the python
+# filters (no case folding, no NULL semantics difference), a limit can then be pushed down
+EXACT_FILTER_OPERATORS = ('=', '>', '>=')
+
+# Clauses of the sql filters: operator -> (clause, clause of an empty reference, parameter of
+# the reference). sqlite matches case-insensitive by default, we make no difference between
+# case-sensitive and case-insensitive here, the python filters will care for the correct matching later
+SQL_FILTER_TEMPLATES = {
+    '=': ('%s = ?', '%s IS NULL', lambda reference: reference),
+    '~': ('%s LIKE ?', None, lambda reference: '%' + reference + '%'),
+    '=~': ('%s = ?', '%s IS NULL', lambda reference: reference.lower()),
+    '~~': ('%s LIKE ?', None, lambda reference: '%' + reference + '%'),
+    '<': ('%s < ?', None, lambda reference: reference),
+    '>': ('%s > ?', None, lambda reference: reference),
+    '<=': ('%s <= ?', None, lambda reference: reference),
+    '>=': ('%s >= ?', None, lambda reference: reference),
+    '!=': ('%s != ?', '%s IS NOT NULL', lambda reference: reference),
+    '!~': ('NOT %s LIKE ?', None, lambda reference: '%' + reference + '%'),
+    '!=~': ('NOT %s = ?', 'NOT %s IS NULL', lambda reference: reference.lower()),
+    '!~~': ('NOT %s LIKE ?', None, lambda reference: '%' + reference + '%'),
+}
+
+# Stats computed in SQL: function -> merge of the partial results of two datafiles
+STATS_FUNCTIONS = {
+    'count': lambda a, b: a + b,
+    'sum': lambda a, b: a + b,
+    'min': min,
+    'max': max,
+}
+
+# Compact storage schema: each string of the dictionary columns is stored once in
+# the logs_dict table, the logs_data table refers to it by id and the logs view
+# joins them back
+STORAGE_SCHEMAS = ('plain', 'compact')
+DICTIONARY_COLUMNS = ('command_name', 'contact_name', 'host_name', 'service_description', 'state_type', 'type')
+DEFAULT_DICTIONARY_CACHE_SIZE = 100000
+
+# Indexes of the logs table, each one is a tuple of columns
+INDEX_PROFILES = {
+    'minimal': (('time',), ('host_name',)),
+    'standard': (('time',), ('host_name',),
+                 ('host_name', 'service_description', 'time'), ('class', 'time')),
+    'full': (('time',), ('host_name',),
+             ('host_name', 'service_description', 'time'), ('class', 'time'),
+             ('type', 'time'), ('contact_name', 'time'), ('state', 'time')),
+}
+
+# SQLite tuning, the journal mode and the pragmas of each performance profile
+PERFORMANCE_PROFILES = {
+    # SQLite defaults, each commit is synced to the disk
+    'durable': {'journal_mode': 'truncate', 'synchronous': 'FULL'},
+    # Write ahead log, the last commits may be lost on a power failure
+    'fast': {'journal_mode': 'wal', 'synchronous': 'NORMAL', 'cache_size': '-65536', 'mmap_size': '268435456',
+             'temp_store': 'MEMORY', 'page_size': '8192', 'wal_autocheckpoint': '1000'},
+    # Loading a big history, a crash may corrupt the database
+    'bulk-load': {'journal_mode': 'memory', 'synchronous': 'OFF', 'cache_size': '-262144',
+                  'mmap_size': '1073741824', 'temp_store': 'MEMORY', 'page_size': '16384'},
+}
+TUNED_PRAGMAS = ('synchronous', 'cache_size', 'mmap_size', 'temp_store', 'page_size', 'wal_autocheckpoint')
+# The pragmas which are set for each attached database
+SCHEMA_PRAGMAS = ('synchronous', 'cache_size', 'mmap_size')
+PRAGMA_VALUE = re.compile(r'^-?\w+$')
+
+# Full-text index of the text columns, searched with a substring of at least 3 characters
+FULLTEXT_COLUMNS = ('message', 'plugin_output')
+FULLTEXT_MIN_LENGTH = 3
+# A reference with these characters is a regular expression, not a plain substring
+REGEX_SPECIAL_CHARS = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+# Ingestion buffer: flush after this many rows or this many seconds
+DEFAULT_INGEST_BUFFER_SIZE = 1000
+DEFAULT_INGEST_BUFFER_MAX_AGE = 1.0
+# Failed insertions of the buffered log lines retried before they are lost, one per buffer max age
+DEFAULT_INGEST_BUFFER_RETRIES = 10
+
+# Log lines which are not to be stored (program messages, eg. "[1278280765] Info: ...")
+IGNORED_LOG_LINE = re.compile(r"^\[[0-9]*\] [A-Z][a-z]*.:")
+
+# Rotation: number of log rows moved to the archives per main loop turn
+DEFAULT_ARCHIVE_CHUNK_SIZE = 10000
+VACUUM_MODES = ('full', 'incremental', 'scheduled', 'none')
+DEFAULT_VACUUM_HOUR = 3
+# Retention: number of expired archives deleted (or moved) per main loop turn
+DEFAULT_EXPIRE_MAX_FILES = 10
+
+# Daily archive file name: <database file name>-YYYY-MM-DD.db
+ARCHIVE_DAY_PATTERN = re.compile(r'-(\d{4})-(\d{2})-(\d{2})(?:-(\d{2}))?\.db(\.gz)?$')
+# Partitions of the days, in hours: the archives of the partitions are named <database file name>-YYYY-MM-DD-HH.db
+PARTITION_HOURS = (1, 2, 3, 4, 6, 8, 12)
+
+# Per-day rollups built in each archive when its day is archived, and the queries
+# which compute them from the logs of a day
+ROLLUP_TABLES = OrderedDict([
+    ('counts', 'class INT, type VARCHAR(64), count INT'),
+    ('states', 'host_name VARCHAR(64), service_description VARCHAR(64), alerts INT, '
+               'first_time INT, first_state INT, last_time INT, last_state INT'),
+])
+ROLLUP_QUERIES = {
+    'counts': 'SELECT class, type, COUNT(*) FROM %(logs)s WHERE %(where)s GROUP BY class, type',
+    # the first and last states of each host and service, from the alerts and the state logs
+    'states': 'SELECT host_name, service_description, SUM(class = %(alert)d), '
+              'MIN(time), (SELECT state FROM %(logs)s AS f WHERE f.host_name = l.host_name '
+              'AND f.service_description IS l.service_description AND class IN (%(alert)d, %(state)d) '
+              'AND %(where)s ORDER BY time, lineno LIMIT 1), '
+              'MAX(time), (SELECT state FROM %(logs)s AS f WHERE f.host_name = l.host_name '
+              'AND f.service_description IS l.service_description AND class IN (%(alert)d, %(state)d) '
+              'AND %(where)s ORDER BY time DESC, lineno DESC LIMIT 1) '
+              'FROM %(logs)s AS l WHERE class IN (%(alert)d, %(state)d) AND %(where)s '
+              'GROUP BY host_name, service_description',
+}
+
+# Decompressed copies of the compressed archives, in MB
+DEFAULT_COMPRESSED_CACHE_SIZE = 512
+
+# Attached archives kept for the next queries, below the sqlite limit of 10 attached databases
+DEFAULT_ATTACH_CACHE_SIZE = 8
+MAX_ATTACH_CACHE_SIZE = 9
+
+# Prepared statements kept by each sqlite connection, the statements of the queries only
+# differ by their archive and their filter shape, the values of the filters are parameters
+DEFAULT_STATEMENT_CACHE_SIZE = 256
+# Plans of the filters of the queries, by the shape of the filter stack
+SQL_STACK_PLANS_SIZE = 1024
+
+# Result cache of the archive queries: number of results (0: no cache) and memory, in MB
+DEFAULT_RESULT_CACHE_MEMORY = 64
+# Key of a filter selecting all the rows of a datafile in the result cache
+ALL_ROWS_CACHE_KEY = ('all',)
+
+# Parallel queries: number of fetched row chunks buffered for each archive, and the
+# seconds waited for a chunk before checking the query workers are still running
+DEFAULT_QUERY_PREFETCH = 4
+QUERY_WORKER_TIMEOUT = 5
+
+# Writer thread: queue size and overflow policies
+DEFAULT_WRITER_QUEUE_SIZE = 10000
+WRITER_OVERFLOW_POLICIES = ('block', 'drop_oldest', 'spill')
+# Seconds waited by the broker to queue a log line before checking the writer thread is running
+WRITER_PUT_TIMEOUT = 1
+
+# Metrics: bounds of the buckets of the latency histograms, in seconds
+METRICS_LATENCY_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0)
+METRICS_BUCKET_LABELS = tuple([str(bound) for bound in METRICS_LATENCY_BUCKETS]) + ('+Inf',)
+
+# Bulk load: rows inserted at once in the staging datafiles
+DEFAULT_BULK_LOAD_BATCH_SIZE = 10000
+
 _do_nothing_lambda = lambda: None
 
 #############################################################################
@@ -130,21 +550,43 @@ class LiveStatusLogStoreSqlite(BaseModule):
             self.max_logs_age = DEFAULT_LOGS_AGE
         maxmatch = re.match(r'^(\d+)([dwmy]*)$', str(self.max_logs_age))
         if maxmatch is None:
+            # The archives never expire
             logger.warning('[LogStore SQLite] Wrong format for max_logs_age. '
                            'Must be <number>[d|w|m|y] or <number> and not %s', self.max_logs_age)
-            return
-        if not maxmatch.group(2):
-            self.max_logs_age = int(maxmatch.group(1))
-        elif maxmatch.group(2) == 'd':
-            self.max_logs_age = int(maxmatch.group(1))
-        elif maxmatch.group(2) == 'w':
-            self.max_logs_age = int(maxmatch.group(1)) * 7
-        elif maxmatch.group(2) == 'm':
-            self.max_logs_age = int(maxmatch.group(1)) * 31
-        elif maxmatch.group(2) == 'y':
-            self.max_logs_age = int(maxmatch.group(1)) * 365
-        logger.info("[LogStore SQLite] maximum log age: %d days", self.max_logs_age)
-        print("[LogStore SQLite] maximum log age: %d days", self.max_logs_age)
+        else:
+            if not maxmatch.group(2):
+                self.max_logs_age = int(maxmatch.group(1))
+            elif maxmatch.group(2) == 'd':
+                self.max_logs_age = int(maxmatch.group(1))
+            elif maxmatch.group(2) == 'w':
+                self.max_logs_age = int(maxmatch.group(1)) * 7
+            elif maxmatch.group(2) == 'm':
+                self.max_logs_age = int(maxmatch.group(1)) * 31
+            elif maxmatch.group(2) == 'y':
+                self.max_logs_age = int(maxmatch.group(1)) * 365
+            logger.info("[LogStore SQLite] maximum log age: %d days", self.max_logs_age)
+            print("[LogStore SQLite] maximum log age: %d days", self.max_logs_age)
+
+        # Retention: the archives older than max_logs_age are deleted, or compressed
+        # and moved to the expired archives path if it is defined
+        self.expired_archives_path = getattr(modconf, 'expired_archives_path', None)
+        logger.info("[LogStore SQLite] expired archives path: %s", self.expired_archives_path)
+        self.expire_max_files = int(getattr(modconf, 'expire_max_files', DEFAULT_EXPIRE_MAX_FILES))
+        logger.info("[LogStore SQLite] expired archives per loop turn: %d", self.expire_max_files)
+        self.expire_pending = False
+
+        # The archives older than compress_archives_after days are compressed (0: never),
+        # they are decompressed when they are queried in a cache of limited size
+        self.compress_archives_after = int(getattr(modconf, 'compress_archives_after', 0))
+        logger.info("[LogStore SQLite] compress the archives after: %d days", self.compress_archives_after)
+        self.compressed_cache_path = getattr(modconf, 'compressed_cache_path', None)
+        self.compressed_cache_size = int(getattr(modconf, 'compressed_cache_size', DEFAULT_COMPRESSED_CACHE_SIZE))
+        logger.info("[LogStore SQLite] decompressed archives cache: %s, %d MB",
+                    self.compressed_cache_path, self.compressed_cache_size)
+        # compressed archive -> (decompressed copy, size), the least recently used first
+        self.compressed_cache = OrderedDict()
+        self.compressed_cache_dir = None
+        self.compress_pending = False
 
         self.use_aggressive_sql = (getattr(modconf, 'use_aggressive_sql', '0') == '1')
         logger.info("[LogStore SQLite] agressive SQL: %s", self.use_aggressive_sql)
@@ -152,19 +594,178 @@ class LiveStatusLogStoreSqlite(BaseModule):
         self.read_only = (getattr(modconf, 'read_only', '0') == '1')
         logger.info("[LogStore SQLite] read only: %s", self.read_only)
 
-        self.journal_mode = getattr(modconf, 'journal_mode', 'truncate')
+        # Light rows: the queries return LiveStatusLogRow rows instead of full Loglines
+        self.light_rows = (getattr(modconf, 'light_rows', '0') == '1')
+        logger.info("[LogStore SQLite] light rows: %s", self.light_rows)
+
+        # Performance profile, each of its pragmas may be changed with a pragma_<name> parameter
+        self.performance_profile = getattr(modconf, 'performance_profile', 'durable')
+        if self.performance_profile not in PERFORMANCE_PROFILES:
+            logger.warning("[LogStore SQLite] Unknown performance profile %s, using durable",
+                           self.performance_profile)
+            self.performance_profile = 'durable'
+        logger.info("[LogStore SQLite] performance profile: %s", self.performance_profile)
+        self.pragmas = dict(PERFORMANCE_PROFILES[self.performance_profile])
+        for name in TUNED_PRAGMAS:
+            value = getattr(modconf, 'pragma_' + name, None)
+            if value is None:
+                continue
+            if not PRAGMA_VALUE.match(value):
+                logger.warning("[LogStore SQLite] Ignoring the invalid pragma_%s: %s", name, value)
+                continue
+            self.pragmas[name] = value
+
+        self.journal_mode = getattr(modconf, 'journal_mode', self.pragmas.pop('journal_mode'))
         logger.info("[LogStore SQLite] journal mode: %s", self.journal_mode)
 
+        # Indexes: a profile name or a comma separated list of indexes, like host_name+time,class+time
+        self.index_profile = getattr(modconf, 'index_profile', 'standard')
+        if self.index_profile in INDEX_PROFILES:
+            self.log_db_indexes = INDEX_PROFILES[self.index_profile]
+        else:
+            self.log_db_indexes = [('time',)]
+            for index in self.index_profile.split(','):
+                columns = tuple([column.strip() for column in index.split('+')])
+                if [column for column in columns if column not in LOGS_COLUMNS]:
+                    logger.warning("[LogStore SQLite] Ignoring the index %s, unknown column", index)
+                elif columns not in self.log_db_indexes:
+                    self.log_db_indexes.append(columns)
+        logger.info("[LogStore SQLite] indexes: %s",
+                    ', '.join(['+'.join(columns) for columns in self.log_db_indexes]))
+
+        # Storage schema of the new datafiles, the plain datafiles are migrated to the compact schema
+        self.storage_schema = getattr(modconf, 'storage_schema', 'plain')
+        if self.storage_schema not in STORAGE_SCHEMAS:
+            logger.warning("[LogStore SQLite] Unknown storage schema: %s, using plain", self.storage_schema)
+            self.storage_schema = 'plain'
+        logger.info("[LogStore SQLite] storage schema: %s", self.storage_schema)
+        # The table which stores the logs of the database: logs, or logs_data for the compact schema
+        self.logs_data_table = 'logs'
+        # Ids of the strings of the dictionary columns
+        self.log_dictionary = {}
+
+        # Optional full-text index of the message and plugin_output columns (SQLite FTS5)
+        self.fulltext_index = (getattr(modconf, 'fulltext_index', '0') == '1')
+        logger.info("[LogStore SQLite] full-text index: %s", self.fulltext_index)
+        self.fts_tables = set()
+
+        # Parsed log lines are buffered and inserted all together
+        self.ingest_buffer_size = int(getattr(modconf, 'ingest_buffer_size', DEFAULT_INGEST_BUFFER_SIZE))
+        logger.info("[LogStore SQLite] ingest buffer size: %d rows", self.ingest_buffer_size)
+        self.ingest_buffer_max_age = float(getattr(modconf, 'ingest_buffer_max_age',
+                                                   DEFAULT_INGEST_BUFFER_MAX_AGE))
+        logger.info("[LogStore SQLite] ingest buffer max age: %.1f seconds", self.ingest_buffer_max_age)
+        self.ingest_buffer_retries = int(getattr(modconf, 'ingest_buffer_retries', DEFAULT_INGEST_BUFFER_RETRIES))
+        logger.info("[LogStore SQLite] ingest buffer retries: %d", self.ingest_buffer_retries)
+        self.ingest_buffer = []
+        self.ingest_buffer_since = None
+        # Failed insertions of the buffer in a row, and the time of the next try
+        self.ingest_failures = 0
+        self.ingest_retry_at = 0
+
+        # Write the log lines in the main thread (inline) or in a dedicated thread
+        self.writer_mode = getattr(modconf, 'writer_mode', 'inline')
+        if self.writer_mode not in ('inline', 'thread'):
+            logger.warning("[LogStore SQLite] Unknown writer mode: %s, using inline", self.writer_mode)
+            self.writer_mode = 'inline'
+        logger.info("[LogStore SQLite] writer mode: %s", self.writer_mode)
+        self.writer_queue_size = int(getattr(modconf, 'writer_queue_size', DEFAULT_WRITER_QUEUE_SIZE))
+        self.writer_overflow_policy = getattr(modconf, 'writer_overflow_policy', 'block')
+        if self.writer_overflow_policy not in WRITER_OVERFLOW_POLICIES:
+            logger.warning("[LogStore SQLite] Unknown writer overflow policy: %s, using block",
+                           self.writer_overflow_policy)
+            self.writer_overflow_policy = 'block'
+        self.writer_spill_file = getattr(modconf, 'writer_spill_file', self.database_file + '.spill')
+        if self.writer_mode == 'thread':
+            logger.info("[LogStore SQLite] writer queue: %d lines, overflow policy: %s",
+                        self.writer_queue_size, self.writer_overflow_policy)
+        self.modconf = modconf
+        self.writer = None
+
+        # The archive moves at most archive_chunk_size rows per loop turn (0 for a whole day at once)
+        self.archive_chunk_size = int(getattr(modconf, 'archive_chunk_size', DEFAULT_ARCHIVE_CHUNK_SIZE))
+        logger.info("[LogStore SQLite] archive chunk size: %d rows", self.archive_chunk_size)
+        # The logs of each partition of the day are moved to their own archive when it is over,
+        # the current datafile only keeps the current partition (0: the whole day)
+        self.partition_hours = int(getattr(modconf, 'partition_hours', '0'))
+        if self.partition_hours and self.partition_hours not in PARTITION_HOURS:
+            logger.warning("[LogStore SQLite] partition hours must be one of %s, the days are not partitioned",
+                           ', '.join([str(hours) for hours in PARTITION_HOURS]))
+            self.partition_hours = 0
+        logger.info("[LogStore SQLite] partition hours: %d", self.partition_hours)
+        self.vacuum_mode = getattr(modconf, 'vacuum_mode', 'incremental')
+        if self.vacuum_mode not in VACUUM_MODES:
+            logger.warning("[LogStore SQLite] Unknown vacuum mode: %s, using incremental", self.vacuum_mode)
+            self.vacuum_mode = 'incremental'
+        self.vacuum_hour = int(getattr(modconf, 'vacuum_hour', DEFAULT_VACUUM_HOUR))
+        logger.info("[LogStore SQLite] vacuum mode: %s", self.vacuum_mode)
+        # Days of the current archive job which are still to be moved
+        self.archive_days = []
+
+        # The archives stay attached to the connection, the least recently used one is detached
+        self.attach_cache_size = int(getattr(modconf, 'attach_cache_size', DEFAULT_ATTACH_CACHE_SIZE))
+        if self.attach_cache_size > MAX_ATTACH_CACHE_SIZE:
+            logger.warning("[LogStore SQLite] attach cache size is limited to %d", MAX_ATTACH_CACHE_SIZE)
+            self.attach_cache_size = MAX_ATTACH_CACHE_SIZE
+        logger.info("[LogStore SQLite] attach cache size: %d archives", self.attach_cache_size)
+        # handle -> datafile of the attached archives, least recently used first
+        self.attached_archives = OrderedDict()
+        # datafiles known to contain the logs table
+        self.logs_tables = set()
+
+        self.statement_cache_size = int(getattr(modconf, 'statement_cache_size', DEFAULT_STATEMENT_CACHE_SIZE))
+        logger.info("[LogStore SQLite] statement cache size: %d", self.statement_cache_size)
+        # (operator, attribute, empty reference) -> (clause, parameter) of the sql filters
+        self.sql_filter_plans = {}
+
+        # The results of the archive queries are cached, an archive only changes with some late logs
+        self.result_cache_entries = int(getattr(modconf, 'result_cache_entries', '0'))
+        self.result_cache_memory = int(getattr(modconf, 'result_cache_memory', DEFAULT_RESULT_CACHE_MEMORY))
+        logger.info("[LogStore SQLite] result cache: %d results, %d MB",
+                    self.result_cache_entries, self.result_cache_memory)
+        self.result_cache = None
+        if self.result_cache_entries:
+            self.result_cache = LiveStatusLogResultCache(self.result_cache_entries,
+                                                         self.result_cache_memory * 1024 * 1024)
+
+        # Counters and latency histograms of the queries, the inserts and the archive (0: disabled)
+        self.metrics = None
+        if getattr(modconf, 'metrics', '0') == '1':
+            self.metrics = LiveStatusLogStoreMetrics()
+        # Their summary is logged every metrics_log_interval seconds (0: never)
+        self.metrics_log_interval = int(getattr(modconf, 'metrics_log_interval', '0'))
+        logger.info("[LogStore SQLite] metrics: %s, logged every %d seconds",
+                    self.metrics is not None, self.metrics_log_interval)
+        self.metrics_logged = None
+        self.next_metrics_log = time.time() + self.metrics_log_interval
+
+        # Query the archives in parallel, each one on its own connection (0 to query them one by one)
+        self.query_workers = int(getattr(modconf, 'query_workers', '0'))
+        self.query_prefetch = int(getattr(modconf, 'query_prefetch', DEFAULT_QUERY_PREFETCH))
+        logger.info("[LogStore SQLite] query workers: %d", self.query_workers)
+        # Pool of the query workers threads, started with the first parallel query
+        self.query_jobs = queue.Queue()
+        self.query_threads = []
+
+        # Index of the archive datafiles: datafile path -> archive entry, with the sorted (start, path).
+        # The archive of a whole day and the partitions of a previous configuration may overlap
+        self.archive_index = {}
+        self.archive_starts = []
+        self.archive_path_mtime = None
+
         self.app = None
         self.dbconn = None
         self.dbcursor = None
         self.sql_filter_stack = None
-        self.sql_time_filter_stack = None
+        self.select_columns = LOGS_SELECT_COLUMNS
+        self.limit = None
+        self.newest_first = False
 
         # self.old_implementation = None
 
         self.next_log_db_commit = None
         self.next_log_db_rotate = None
+        self.next_log_db_vacuum = None
 
         # Now sleep one second, so that won't get lineno collisions with the last second
         time.sleep(1)
@@ -189,30 +790,60 @@ class LiveStatusLogStoreSqlite(BaseModule):
     def open(self):
         logger.debug("[Logstore SQLite] opening LiveStatusLogStoreSqlite DB: %s", self.database_file)
 
-        self.dbconn = sqlite3.connect(self.database_file)
+        self.dbconn = sqlite3.connect(self.database_file, cached_statements=self.statement_cache_size)
         # Get no problem for utf8 insert
         self.dbconn.text_factory = str
         self.dbcursor = self.make_cursor()
 
-        # This stack is used to create a full-blown select-statement
+        if self.fulltext_index:
+            try:
+                self.dbconn.execute("CREATE VIRTUAL TABLE temp.logs_fts_check USING fts5(text, tokenize='trigram')")
+                self.dbconn.execute("DROP TABLE temp.logs_fts_check")
+            except sqlite3.Error as exp:
+                logger.warning("[LogStore SQLite] full-text index not available in SQLite %s: %s",
+                               sqlite3.sqlite_version, str(exp))
+                self.fulltext_index = False
+
+        # This stack is used to create a full-blown select-statement, the
+        # time range of the resulting filter selects the relevant datafiles
         self.sql_filter_stack = LiveStatusSqlStack()
-        # This stack is used to create a minimal select-statement which
-        # selects only by time >= and time <=
-        self.sql_time_filter_stack = LiveStatusSqlStack()
 
-        # self.execute("PRAGMA cache_size = 200000")
+        self.set_log_db_pragmas(self.dbconn)
+        self.logs_data_table = self.log_db_data_table()
+        self.log_dictionary.clear()
+        for name in TUNED_PRAGMAS:
+            logger.info("[LogStore SQLite] pragma %s: %s", name,
+                        self.dbconn.execute("PRAGMA %s" % name).fetchone()[0])
 
         # Start with commit and rotate immediately so the interval timers
         # get initialized properly
         now = time.time()
         self.next_log_db_commit = now
         self.next_log_db_rotate = now
+        self.next_log_db_vacuum = self.next_daily_time(self.vacuum_hour, 0)
+
+        self.log_db_build_archive_index()
+
+        if self.writer_mode == 'thread' and not self.read_only and self.writer is None:
+            self.writer = LiveStatusLogStoreWriter(self.modconf, self.writer_queue_size,
+                                                   self.writer_overflow_policy, self.writer_spill_file)
+            self.writer.start()
 
     def close(self):
+        if self.writer is not None:
+            # Let the writer thread store the queued log lines
+            self.writer.stop()
+            self.writer = None
+        self.stop_query_workers()
+
         if self.dbconn is not None:
-            self.dbconn.commit()
+            # Do not lose the buffered log lines, try now if they wait for a retry
+            self.ingest_retry_at = 0
+            self.commit()
             self.dbconn.close()
             self.dbconn = None
+        self.attached_archives.clear()
+        self.log_db_clear_decompressed()
 
         if not self.max_logs_age:
             # Again, if max_logs_age is 0, we don't care for archives.
@@ -227,48 +858,183 @@ class LiveStatusLogStoreSqlite(BaseModule):
     def prepare_log_db_table(self, table_name='logs'):
         if self.read_only:
             return
-        # 'attempt', 'class', 'command_name', 'comment', 'contact_name', 'host_name', 'lineno', 'message',
-        # 'plugin_output', 'service_description', 'state', 'state_type', 'time', 'type',
-        cmd = """CREATE TABLE IF NOT EXISTS %s (
-                logobject INT,
-                attempt INT,
-                class INT,
-                command_name VARCHAR(64),
-                comment VARCHAR(256),
-                contact_name VARCHAR(64),
-                host_name VARCHAR(64),
-                lineno INT,
-                message VARCHAR(512),
-                options VARCHAR(512),
-                plugin_output VARCHAR(256),
-                service_description VARCHAR(64),
-                state INT,
-                state_type VARCHAR(10),
-                time INT,
-                type VARCHAR(64)
-        )""" % table_name
-        self.execute(cmd)
-
-        self.execute("CREATE INDEX IF NOT EXISTS logs_time ON %s (time)" % table_name)
-        self.execute("CREATE INDEX IF NOT EXISTS logs_host_name ON %s (host_name)" % table_name)
-        self.execute("PRAGMA journal_mode=%s" % self.journal_mode)
+        schema = table_name.split('.')[0] if '.' in table_name else 'main'
+        if table_name == 'logs' and self.vacuum_mode == 'incremental':
+            # Only effective when the database is created, else the next VACUUM applies it
+            self.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            if self.dbcursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                logger.info("[Logstore SQLite] the incremental vacuum will be active after a full "
+                            "VACUUM of the database, until then the free pages are reused")
+        if self.storage_schema == 'compact':
+            self.create_log_db_compact_schema(schema)
+        else:
+            self.execute("CREATE TABLE IF NOT EXISTS %s (%s)"
+                         % (table_name, ', '.join(['%s %s' % column for column in LOGS_COLUMN_TYPES])))
+
+        self.create_log_db_indexes(table_name)
+        if self.fulltext_index:
+            self.create_log_db_fulltext_index(table_name)
+        self.execute("PRAGMA %s.journal_mode=%s" % (schema, self.journal_mode))
+        self.commit()
+        if schema == 'main':
+            self.logs_data_table = self.log_db_data_table()
+
+    def create_log_db_compact_schema(self, schema='main'):
+        """
+        Create the tables of the compact storage schema: logs_dict stores each string
+        of the dictionary columns once, logs_data stores the logs with the ids of their
+        strings and the logs view joins them back. The view also returns the rowid of
+        the logs_data rows. It is the logs table of the plain schema for the queries
+        and the inserts. A plain logs table is migrated to the compact schema.
+        """
+        objects = dict(self.execute("SELECT name, type FROM %s.sqlite_master WHERE name = 'logs'" % schema))
+        if objects.get('logs') == 'view':
+            return
+        self.execute("CREATE TABLE IF NOT EXISTS %s.logs_dict (id INTEGER PRIMARY KEY, value TEXT UNIQUE)" % schema)
+        self.execute("CREATE TABLE IF NOT EXISTS %s.logs_data (%s)"
+                     % (schema, ', '.join(['%s %s' % (name, 'INT' if name in DICTIONARY_COLUMNS else column_type)
+                                           for name, column_type in LOGS_COLUMN_TYPES])))
+        if objects.get('logs') == 'table':
+            logger.info("[Logstore SQLite] migrating %s.logs to the compact storage schema...", schema)
+            self.execute("INSERT OR IGNORE INTO %s.logs_dict (value) %s"
+                         % (schema, ' UNION '.join(["SELECT %s FROM %s.logs WHERE %s IS NOT NULL"
+                                                    % (column, schema, column) for column in DICTIONARY_COLUMNS])))
+            self.execute("INSERT INTO %s.logs_data (%s) SELECT %s FROM %s.logs AS plain ORDER BY plain.rowid"
+                         % (schema, LOGS_SELECT_COLUMNS,
+                            ', '.join(['(SELECT id FROM %s.logs_dict WHERE value = plain.%s)' % (schema, column)
+                                       if column in DICTIONARY_COLUMNS else 'plain.' + column
+                                       for column in LOGS_COLUMNS]), schema))
+            # Its indexes and triggers are dropped with the table
+            self.execute("DROP TABLE IF EXISTS %s.logs_fts" % schema)
+            self.execute("DROP TABLE %s.logs" % schema)
+
+        columns = []
+        joins = []
+        for column in LOGS_COLUMNS:
+            if column in DICTIONARY_COLUMNS:
+                columns.append('dict_%s.value AS %s' % (column, column))
+                joins.append('LEFT JOIN logs_dict AS dict_%s ON dict_%s.id = data.%s' % (column, column, column))
+            else:
+                columns.append('data.%s AS %s' % (column, column))
+        columns.append('data.rowid AS rowid')
+        self.execute("CREATE VIEW %s.logs AS SELECT %s FROM logs_data AS data %s"
+                     % (schema, ', '.join(columns), ' '.join(joins)))
+        self.execute("CREATE TRIGGER %s.logs_insert INSTEAD OF INSERT ON logs BEGIN %s "
+                     "INSERT INTO logs_data (%s) VALUES (%s); END"
+                     % (schema,
+                        ' '.join(["INSERT OR IGNORE INTO logs_dict (value) SELECT new.%s WHERE new.%s IS NOT NULL;"
+                                  % (column, column) for column in DICTIONARY_COLUMNS]),
+                        LOGS_SELECT_COLUMNS,
+                        ', '.join(['(SELECT id FROM logs_dict WHERE value = new.%s)' % column
+                                   if column in DICTIONARY_COLUMNS else 'new.' + column
+                                   for column in LOGS_COLUMNS])))
+        self.commit()
+
+    def log_db_data_table(self, schema='main'):
+        """Return the table which stores the logs: logs_data for the compact schema, else logs"""
+        if self.execute("SELECT name FROM %s.sqlite_master WHERE type='table' AND name='logs_data'" % schema):
+            return 'logs_data'
+        return 'logs'
+
+    def log_db_encode_row(self, row):
+        """Replace the strings of the dictionary columns of a row by their ids"""
+        row = list(row)
+        for position, column in enumerate(LOGS_COLUMNS):
+            value = row[position]
+            if column not in DICTIONARY_COLUMNS or value is None:
+                continue
+            value_id = self.log_dictionary.get(value)
+            if value_id is None:
+                if len(self.log_dictionary) >= DEFAULT_DICTIONARY_CACHE_SIZE:
+                    self.log_dictionary.clear()
+                self.dbcursor.execute("INSERT OR IGNORE INTO logs_dict (value) VALUES (?)", (value,))
+                value_id = self.dbcursor.execute("SELECT id FROM logs_dict WHERE value = ?", (value,)).fetchone()[0]
+                self.log_dictionary[value] = value_id
+            row[position] = value_id
+        return row
+
+    def set_log_db_pragmas(self, dbconn, schema=None):
+        """Set the pragmas of the performance profile on a connection,
+        or the pragmas of one of its databases, like an attached archive.
+        The page size of an existing database only changes with a VACUUM.
+        """
+        for name in TUNED_PRAGMAS:
+            if name not in self.pragmas:
+                continue
+            if schema is None:
+                dbconn.execute("PRAGMA %s = %s" % (name, self.pragmas[name])).fetchall()
+            elif name in SCHEMA_PRAGMAS:
+                dbconn.execute("PRAGMA %s.%s = %s" % (schema, name, self.pragmas[name])).fetchall()
+
+    def create_log_db_indexes(self, table_name='logs'):
+        """Create the indexes of the index profile which do not exist yet.
+        :param table_name: logs or handle.logs for an attached database
+        """
+        schema = table_name.split('.')[0] if '.' in table_name else 'main'
+        data_table = self.log_db_data_table(schema)
+        for columns in self.log_db_indexes:
+            self.execute("CREATE INDEX IF NOT EXISTS %s.logs_%s ON %s (%s)"
+                         % (schema, '_'.join(columns), data_table, ', '.join(columns)))
+
+    def create_log_db_fulltext_index(self, table_name='logs'):
+        """Create the full-text index of the message and plugin_output columns.
+        It is an external content FTS5 table, triggers keep it in sync with the
+        logs table when the lines are inserted or moved to their archive.
+        :param table_name: logs or handle.logs for an attached database
+        """
+        schema = table_name.split('.')[0] if '.' in table_name else 'main'
+        table_name = self.log_db_data_table(schema)
+        if tuple(self.select("SELECT name FROM %s.sqlite_master WHERE type='table' AND name='logs_fts'" % schema)):
+            return
+        logger.info("[Logstore SQLite] creating the full-text index of %s.%s", schema, table_name)
+        self.execute("CREATE VIRTUAL TABLE %s.logs_fts USING fts5(%s, content='%s', content_rowid='rowid', "
+                     "tokenize='trigram')" % (schema, ', '.join(FULLTEXT_COLUMNS), table_name))
+        self.execute("CREATE TRIGGER %s.logs_fts_insert AFTER INSERT ON %s BEGIN "
+                     "INSERT INTO logs_fts(rowid, %s) VALUES (new.rowid, %s); END"
+                     % (schema, table_name, ', '.join(FULLTEXT_COLUMNS),
+                        ', '.join(['new.' + column for column in FULLTEXT_COLUMNS])))
+        self.execute("CREATE TRIGGER %s.logs_fts_delete AFTER DELETE ON %s BEGIN "
+                     "INSERT INTO logs_fts(logs_fts, rowid, %s) VALUES ('delete', old.rowid, %s); END"
+                     % (schema, table_name, ', '.join(FULLTEXT_COLUMNS),
+                        ', '.join(['old.' + column for column in FULLTEXT_COLUMNS])))
+        # Index the lines already stored
+        self.execute("INSERT INTO %s.logs_fts(logs_fts) VALUES ('rebuild')" % schema)
         self.commit()
 
+    @staticmethod
+    def next_daily_time(hour, minute):
+        """Return the timestamp of the next hour:minute"""
+        now = time.time()
+        today = datetime.date.today()
+        next_time = datetime.datetime(today.year, today.month, today.day, hour, minute, 0)
+        if now >= time.mktime(next_time.timetuple()):
+            next_time = next_time + datetime.timedelta(days=1)
+        return time.mktime(next_time.timetuple())
+
     def commit_and_rotate_log_db(self):
         """Submit a commit or rotate the complete database file.
 
         This function is called whenever the mainloop doesn't handle a request.
         The database updates are committed every second.
         Every day at 00:05 the database contents with a timestamp of past days
-        are moved to their own datafiles (one for each day). We wait until 00:05
+        are moved to their own datafiles (one for each day, or for each partition
+        of partition_hours hours, which are then moved 5 minutes after their end
+        all day long). We wait until 00:05
         because in a distributed environment even after 00:00 (on the broker host)
         we might receive data from other hosts with a timestamp dating from yesterday.
+        The rows are moved by chunks of archive_chunk_size rows, one chunk per call,
+        so that the livestatus queries are still handled during the rotation.
         """
-        if self.read_only:
+        now = time.time()
+        if self.metrics is not None and self.metrics_log_interval and self.next_metrics_log <= now:
+            self.log_metrics()
+            self.next_metrics_log = now + self.metrics_log_interval
+
+        if self.read_only or self.writer is not None:
+            # The writer thread commits and rotates on its own connection
             return
 
-        now = time.time()
-        if self.next_log_db_commit <= now:
+        if self.next_log_db_commit <= now or self.ingest_buffer_expired(now):
             logger.debug("[Logstore SQLite] commiting")
             self.commit()
             # Commit every second!
@@ -278,19 +1044,29 @@ class LiveStatusLogStoreSqlite(BaseModule):
             logger.info("[Logstore SQLite] rotating the database file...")
             # Take the current database file
             # Move the messages into daily files
-            self.log_db_do_archive()
-
-            today = datetime.date.today()
-            today0005 = datetime.datetime(today.year, today.month, today.day, 0, 5, 0)
-            if now < time.mktime(today0005.timetuple()):
-                nextrotation = today0005
+            if self.archive_chunk_size:
+                self.log_db_start_archive()
             else:
-                nextrotation = today0005 + datetime.timedelta(days=1)
-
-            # See you tomorrow
-            self.next_log_db_rotate = time.mktime(nextrotation.timetuple())
+                self.log_db_do_archive()
+            # Then delete the expired archives and compress the old ones
+            self.expire_pending = True
+            self.compress_pending = True
+
+            # See you tomorrow, or at the end of the current partition
+            self.next_log_db_rotate = min([self.next_daily_time(hour, 5)
+                                           for hour in range(0, 24, self.partition_hours or 24)])
             logger.info("[Logstore SQLite] next rotation at %s ",
                         time.asctime(time.localtime(self.next_log_db_rotate)))
+        elif self.archive_days:
+            self.log_db_archive_step(self.archive_chunk_size)
+        elif self.expire_pending:
+            self.expire_pending = self.log_db_expire_archives(self.expire_max_files)
+        elif self.compress_pending:
+            self.compress_pending = self.log_db_compress_archives(self.expire_max_files)
+
+        if self.vacuum_mode == 'scheduled' and self.next_log_db_vacuum <= now and not self.archive_days:
+            self.log_db_vacuum()
+            self.next_log_db_vacuum = self.next_daily_time(self.vacuum_hour, 0)
 
     def log_db_historic_contents(self):
         """
@@ -326,7 +1102,8 @@ class LiveStatusLogStoreSqlite(BaseModule):
         be found.
         If the preview parameter is false, only names of existing files
         are returned.
-        The result is a list with one element for each day. The elements
+        The result is a list with one element for each day, or for each
+        partition of a day if partition_hours is set. The elements
         themselves are lists consisting of the the following items:
         - A Datetime object
         - A short string of a day's date in the form db%Y%m%d
@@ -347,32 +1124,203 @@ class LiveStatusLogStoreSqlite(BaseModule):
         if max_day >= today:
             # Only loop until yesterday
             max_day = today - datetime.timedelta(days=1)
-        this_day = min_day
-        while this_day <= max_day:
-            nextday = this_day + datetime.timedelta(days=1)
-            handle = "db" + this_day.strftime("%Y%m%d")
-            archive = os.path.join(self.archive_path,
-                                   os.path.splitext(os.path.basename(self.database_file))[0]
-                                   + "-"
-                                   + this_day.strftime("%Y-%m-%d") + ".db")
-            if os.path.exists(archive) or preview:
-                result.append([this_day,
-                               handle,
-                               archive,
-                               int(time.mktime(this_day.timetuple())),
-                               int(time.mktime(nextday.timetuple()))])
-            this_day = nextday
-        if maxtime >= int(time.mktime(today.timetuple())):
+        if preview:
+            this_day = min_day
+            while this_day <= max_day:
+                result.extend(self.log_db_archive_partitions(this_day, mintime, maxtime))
+                this_day = this_day + datetime.timedelta(days=1)
+            if self.partition_hours:
+                # The partitions of today which are over
+                now = time.time()
+                result.extend([day for day in self.log_db_archive_partitions(today, mintime, maxtime)
+                               if day[4] <= now])
+        else:
+            # Only the existing archives, found in the archive index, some of today if the days are partitioned
+            self.log_db_refresh_archive_index()
+            first = bisect.bisect_left(self.archive_starts, (int(time.mktime(min_day.timetuple())),))
+            last = bisect.bisect_left(self.archive_starts, (maxtime + 1,))
+            for _, key in self.archive_starts[first:last]:
+                entry = self.archive_index[key]
+                mtime = self.log_db_archive_mtime(entry['day'][2])
+                if mtime is None:
+                    # Deleted by another process
+                    self.log_db_unindex_archive(key)
+                    continue
+                if entry['mtime'] != mtime:
+                    # Modified by another process
+                    self.log_db_index_archive(entry['day'])
+                    entry = self.archive_index[key]
+                if entry['count'] == 0 or entry['max_time'] < mintime or entry['min_time'] > maxtime:
+                    continue
+                result.append(entry['day'])
+        current = int(time.mktime((self.log_db_partition_start(time.time()) if self.partition_hours
+                                   else today).timetuple()))
+        # Some of the relevant logs may not be moved to their archive yet: the previous day
+        # or partition until the rotation, the days of a running archive job or some late logs
+        oldest = None if preview else self.log_db_main_oldest_time()
+        if maxtime >= current:
             # Also today's data are relevant, so we add the current database
-            result.append([today, "main", self.database_file, int(time.mktime(today.timetuple())), maxtime])
+            result.append([today, "main", self.database_file, min(current, oldest or current), maxtime])
+        elif oldest is not None and oldest <= maxtime:
+            result.append([today, "main", self.database_file, oldest, maxtime])
         return result
 
-    def log_db_do_archive(self):
+    def log_db_main_oldest_time(self):
+        """Return the time of the oldest log of the current datafile, None if it is empty"""
+        return self.execute("SELECT MIN(time) FROM logs")[0][0]
+
+    def log_db_archive_day(self, this_day, hour=None):
+        """Return the day description of log_db_relevant_files for a day, or for its partition of an hour"""
+        if hour is None:
+            start = this_day
+            end = this_day + datetime.timedelta(days=1)
+            handle = "db" + this_day.strftime("%Y%m%d")
+            suffix = ""
+        else:
+            start = this_day + datetime.timedelta(hours=hour)
+            # until the end of the day for the partitions of a previous configuration
+            end = this_day + datetime.timedelta(hours=hour + (self.partition_hours or 24 - hour))
+            handle = "db%s%02d" % (this_day.strftime("%Y%m%d"), hour)
+            suffix = "-%02d" % hour
+        archive = os.path.join(self.archive_path,
+                               os.path.splitext(os.path.basename(self.database_file))[0]
+                               + "-"
+                               + this_day.strftime("%Y-%m-%d") + suffix + ".db")
+        return [this_day,
+                handle,
+                archive,
+                int(time.mktime(start.timetuple())),
+                int(time.mktime(end.timetuple()))]
+
+    def log_db_archive_partitions(self, this_day, mintime, maxtime):
         """
-        In order to limit the datafile's sizes we flush logs dating from
-        before today/00:00 to their own datafiles.
+        Return the day descriptions of the partitions of a day which intersect a time range,
+        or the description of the whole day if the days are not partitioned or if the day
+        was archived as a whole.
         """
-        if self.read_only:
+        day = self.log_db_archive_day(this_day)
+        if not self.partition_hours or os.path.exists(day[2]) or os.path.exists(day[2] + '.gz'):
+            return [day]
+        return [day for day in [self.log_db_archive_day(this_day, hour)
+                                for hour in range(0, 24, self.partition_hours)]
+                if day[4] > mintime and day[3] <= maxtime]
+
+    def log_db_partition_start(self, timestamp):
+        """Return the start of the partition of a time"""
+        this_time = datetime.datetime.fromtimestamp(timestamp)
+        return datetime.datetime(this_time.year, this_time.month, this_time.day,
+                                 this_time.hour - this_time.hour % self.partition_hours, 0, 0)
+
+    @staticmethod
+    def log_db_archive_key(day):
+        """Return the key of an archive in the archive index: its datafile, also for its compressed copy"""
+        return day[2][:-len('.gz')] if day[2].endswith('.gz') else day[2]
+
+    @staticmethod
+    def log_db_archive_mtime(archive):
+        try:
+            return os.stat(archive).st_mtime
+        except OSError:
+            return None
+
+    def log_db_build_archive_index(self):
+        """
+        Index the archive datafiles found in the archive path, with
+        the time range and the number of logs of each of them.
+        """
+        self.archive_index = {}
+        self.archive_starts = []
+        self.archive_path_mtime = None
+        self.log_db_refresh_archive_index()
+        logger.info("[Logstore SQLite] %d archives indexed in %s", len(self.archive_starts), self.archive_path)
+
+    def log_db_refresh_archive_index(self):
+        """Update the archive index when some archives were created or deleted"""
+        mtime = self.log_db_archive_mtime(self.archive_path)
+        if mtime == self.archive_path_mtime:
+            return
+        self.archive_path_mtime = mtime
+
+        prefix = os.path.splitext(os.path.basename(self.database_file))[0]
+        found = {}
+        if mtime is not None:
+            # The datafile of a day comes before its compressed copy, which is then ignored
+            for filename in sorted(os.listdir(self.archive_path)):
+                match = ARCHIVE_DAY_PATTERN.search(filename)
+                if match is None or filename[:match.start()] != prefix:
+                    continue
+                day = self.log_db_archive_day(datetime.datetime(*[int(x) for x in match.groups()[:3]]),
+                                              None if match.group(4) is None else int(match.group(4)))
+                if match.group(5):
+                    if day[2] in found:
+                        continue
+                    found[day[2]] = day[:2] + [day[2] + match.group(5)] + day[3:]
+                else:
+                    found[day[2]] = day
+        for key, day in found.items():
+            entry = self.archive_index.get(key)
+            if entry is None:
+                self.log_db_index_archive(day)
+            elif entry['day'][2] + '.gz' == day[2]:
+                # Compressed by another process, same contents
+                entry['day'] = day
+                entry['mtime'] = self.log_db_archive_mtime(day[2])
+            elif entry['day'][2] != day[2]:
+                self.log_db_index_archive(day)
+        for key in [key for key in self.archive_index if key not in found]:
+            self.log_db_unindex_archive(key)
+
+    def log_db_index_archive(self, day):
+        """Add (or update) an archive in the index, reading its contents"""
+        mintime = maxtime = None
+        count = 0
+        mtime = self.log_db_archive_mtime(day[2])
+        if day[2].endswith('.gz'):
+            # Not read until it is queried, its logs are somewhere in the day
+            self.log_db_update_archive_index(day, 0, None, None, mtime, replace=True)
+            self.archive_index[self.log_db_archive_key(day)].update({'count': None, 'min_time': day[3],
+                                                                     'max_time': day[4] - 1})
+            return
+        try:
+            dbconn = sqlite3.connect(day[2])
+            try:
+                mintime, maxtime, count = dbconn.execute('SELECT MIN(time), MAX(time), COUNT(*) FROM logs').fetchone()
+            finally:
+                dbconn.close()
+        except sqlite3.Error as exp:
+            logger.warning("[Logstore SQLite] can not index the archive %s: %s", day[2], str(exp))
+        self.log_db_update_archive_index(day, count, mintime, maxtime, mtime, replace=True)
+
+    def log_db_update_archive_index(self, day, count, mintime, maxtime, mtime=None, replace=False):
+        """Add some logs to the index entry of an archive"""
+        key = self.log_db_archive_key(day)
+        entry = self.archive_index.get(key)
+        if entry is None or replace:
+            if entry is None:
+                bisect.insort(self.archive_starts, (day[3], key))
+            entry = self.archive_index[key] = {
+                'day': day, 'count': 0, 'min_time': None, 'max_time': None, 'mtime': None
+            }
+        if count:
+            entry['count'] += count
+            entry['min_time'] = mintime if entry['min_time'] is None else min(entry['min_time'], mintime)
+            entry['max_time'] = maxtime if entry['max_time'] is None else max(entry['max_time'], maxtime)
+        entry['mtime'] = mtime if mtime is not None else self.log_db_archive_mtime(day[2])
+
+    def log_db_unindex_archive(self, key):
+        entry = self.archive_index.pop(key, None)
+        if entry is None:
+            return
+        position = bisect.bisect_left(self.archive_starts, (entry['day'][3], key))
+        if position < len(self.archive_starts) and self.archive_starts[position] == (entry['day'][3], key):
+            del self.archive_starts[position]
+
+    def log_db_start_archive(self):
+        """
+        Prepare the archive job: the list of the past days which have some
+        logs in the current datafile. Nothing is done if a job is still running.
+        """
+        if self.read_only or self.archive_days:
             return
 
         try:
@@ -381,57 +1329,562 @@ class LiveStatusLogStoreSqlite(BaseModule):
             logger.warning("Creating archive path: %s", self.archive_path)
             os.mkdir(self.archive_path)
 
-        for day in self.log_db_historic_contents():
-            _, handle, archive, starttime, stoptime = day
+        # Archive the buffered log lines too
+        self.commit()
+
+        self.archive_days = [day + [0] for day in self.log_db_historic_contents() if day[1] != "main"]
+
+    def log_db_do_archive(self):
+        """
+        In order to limit the datafile's sizes we flush logs dating from
+        before today/00:00 to their own datafiles.
+        """
+        if self.read_only:
+            return
+
+        start = time.time()
+        self.log_db_start_archive()
+        while self.log_db_archive_step():
+            pass
+        if self.metrics is not None:
+            self.metrics.observe('archive', time.time() - start)
+
+    def log_db_archive_step(self, max_rows=0):
+        """
+        Move at most max_rows logs (all of them if 0) of the first day of the archive
+        job to the day's datafile.
+        The rows are copied and deleted in the same transaction, so a query
+        finds them either in the current datafile or in the archive.
+        :return: True if the archive job is not yet finished
+        """
+        if not self.archive_days:
+            return False
+
+        _, handle, archive, starttime, stoptime, moved = self.archive_days[0]
+        if not moved and not self.execute("SELECT 1 FROM logs WHERE time >= %d AND time < %d LIMIT 1"
+                                          % (starttime, stoptime)):
+            # No logs for this day, its archive is neither created nor decompressed
+            self.archive_days.pop(0)
+            return bool(self.archive_days)
+        self.log_db_reopen_archive(self.archive_days[0][:5])
+        if not os.path.exists(archive):
+            # Create an empty datafile with the logs table
+            dbmodconf = Module({
+                'module_name': 'LogStore',
+                'module_type': 'logstore_sqlite',
+                'use_aggressive_sql': '0',
+                'database_file': archive,
+                'max_logs_age': '1',    # Only 1 day archive!
+                'vacuum_mode': 'none',  # Never shrinked
+                'index_profile': self.index_profile,
+                'fulltext_index': '1' if self.fulltext_index else '0',
+                'storage_schema': self.storage_schema,
+                'performance_profile': self.performance_profile,
+                'journal_mode': 'truncate'  # Written once
+            })
+            for name, value in self.pragmas.items():
+                setattr(dbmodconf, 'pragma_' + name, value)
+            tmpconn = LiveStatusLogStoreSqlite(dbmodconf)
+            tmpconn.open()
+            tmpconn.prepare_log_db_table()
+            tmpconn.close()
+
+        detach = self.attach_archive(handle, archive)
+        self.log_db_check_archive(handle, archive, create_if_not_exist=True)
+
+        where = "time >= %d AND time < %d" % (starttime, stoptime)
+        if max_rows:
+            # The chunk ends at the time of its last log, read from the time index. The moved
+            # logs are deleted, each step only reads the index and the logs of its chunk
+            result = self.execute("SELECT time FROM logs WHERE %s ORDER BY time LIMIT 1 OFFSET %d"
+                                  % (where, max_rows - 1))
+            if result:
+                where = "time >= %d AND time <= %d" % (starttime, result[0][0])
+            else:
+                # This is the last chunk
+                max_rows = 0
+
+        result = self.execute("SELECT count(*), MIN(time), MAX(time) FROM logs WHERE %s" % where)
+        log_count, mintime, maxtime = result[0]
+        self.execute("INSERT INTO %s.logs (%s) SELECT %s FROM logs WHERE %s"
+                     % (handle, LOGS_SELECT_COLUMNS, LOGS_SELECT_COLUMNS, where))
+        self.execute("DELETE FROM %s WHERE %s" % (self.logs_data_table, where))
+        if not max_rows:
+            # The day is complete, until some late logs
+            self.log_db_build_rollups(handle)
+            self.log_db_update_snapshots(handle, starttime)
+        self.commit()
+        detach()
+        self.log_db_update_archive_index(self.archive_days[0][:5], log_count, mintime, maxtime)
+
+        moved += log_count
+        self.archive_days[0][5] = moved
+        if self.metrics is not None:
+            self.metrics.count('rows_archived', log_count)
+        if max_rows:
+            logger.debug("[Logstore SQLite] moved %d logs to database %s", log_count, archive)
+            if self.vacuum_mode == 'incremental':
+                self.log_db_vacuum()
+            return True
+
+        logger.info("[Logstore SQLite] moved %d logs from %s - %s to database %s", moved,
+                    time.asctime(time.localtime(starttime)),
+                    time.asctime(time.localtime(stoptime)), archive)
+        self.archive_days.pop(0)
+
+        if self.vacuum_mode in ('full', 'incremental'):
+            self.log_db_vacuum(full=(self.vacuum_mode == 'full'))
+        return bool(self.archive_days)
+
+    def log_db_reopen_archive(self, day):
+        """Decompress the compressed archive of a day again, before some late logs are added to it"""
+        archive = day[2]
+        if os.path.exists(archive) or not os.path.exists(archive + '.gz'):
+            return
+        logger.info("[Logstore SQLite] decompressing the archive %s for late logs", archive)
+        self.log_db_evict_decompressed(archive + '.gz')
+        self.log_db_decompress_archive(archive + '.gz', archive)
+        os.remove(archive + '.gz')
+        self.log_db_index_archive(day)
+
+    @staticmethod
+    def log_db_rollup_query(rollup, logs, where='1 = 1'):
+        """Return the query which computes a rollup from the logs of a day"""
+        return ROLLUP_QUERIES[rollup] % {'logs': logs, 'where': where,
+                                         'alert': LOGCLASS_ALERT, 'state': LOGCLASS_STATE}
+
+    def log_db_build_rollups(self, handle):
+        """(Re)build the rollup tables of an attached archive from its logs"""
+        for rollup, columns in ROLLUP_TABLES.items():
+            table = '%s.logs_day_%s' % (handle, rollup)
+            self.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (table, columns))
+            self.execute("DELETE FROM %s" % table)
+            self.execute("INSERT INTO %s %s" % (table, self.log_db_rollup_query(rollup, handle + '.logs')))
+
+    def get_log_rollups(self, rollup, from_time, to_time):
+        """
+        Return the per-day rollups of the days of a time range, read from the rollup tables
+        of the archives. They are computed from the logs for the current datafile and the
+        archives built before the rollups existed.
+        :param rollup: counts: (class, type, count) of the logs,
+        states: (host_name, service_description, alerts, first_time, first_state,
+        last_time, last_state) of the hosts and services which have alerts or state logs
+        :param from_time: the whole days which intersect the time range are returned
+        :param to_time:
+        :return: the list of the rows of the rollup, each one prefixed with the start of its day
+        """
+        if rollup not in ROLLUP_TABLES:
+            raise LiveStatusLogStoreError("Unknown rollup: %s" % rollup)
+        # make the buffered log lines visible to this query
+        self.flush_ingest_buffer()
+
+        result = []
+        for _, handle, archive, day_from, day_to in self.log_db_relevant_files(from_time, to_time):
             if handle == "main":
-                # Skip archiving of today's contents
+                # Today and the days which are not yet archived
+                for day in self.log_db_relevant_files(day_from, day_to, True):
+                    end = day[4]
+                    if day[1] == "main":
+                        end = int(time.mktime((day[0] + datetime.timedelta(days=1)).timetuple()))
+                    where = 'time >= %d AND time < %d' % (day[3], end)
+                    result.extend([(day[3],) + tuple(row)
+                                   for row in self.log_db_datafile_rollup(rollup, handle, archive, where)])
                 continue
-            if not os.path.exists(archive):
-                # Create an empty datafile with the logs table
-                dbmodconf = Module({
-                    'module_name': 'LogStore',
-                    'module_type': 'logstore_sqlite',
-                    'use_aggressive_sql': '0',
-                    'database_file': archive,
-                    'max_logs_age': '1'     # Only 1 day archive!
-                })
-                tmpconn = LiveStatusLogStoreSqlite(dbmodconf)
-                tmpconn.open()
-                tmpconn.prepare_log_db_table()
-                tmpconn.close()
+            result.extend([(day_from,) + tuple(row)
+                           for row in self.log_db_datafile_rollup(rollup, handle, archive)])
+        return result
 
+    def log_db_datafile_rollup(self, rollup, handle, archive, where=None):
+        """
+        Return the rows of a rollup of a datafile: they are read from its rollup table when
+        the whole archive is concerned, else computed from the logs of the where-clause.
+        """
+        if handle == "main":
+            return self.execute(self.log_db_rollup_query(rollup, 'logs', where or '1 = 1'))
+        if archive.endswith('.gz'):
+            try:
+                archive = self.log_db_decompressed_archive(archive)
+            except (IOError, OSError) as exp:
+                raise LiveStatusLogStoreError(exp)
+        detach = self.attach_archive(handle, archive)
+        try:
+            if not self.log_db_check_archive(handle, archive):
+                return []
+            if where is None and self.execute("SELECT name FROM %s.sqlite_master "
+                                              "WHERE type='table' AND name='logs_day_%s'" % (handle, rollup)):
+                return self.execute("SELECT * FROM %s.logs_day_%s" % (handle, rollup))
+            return self.execute(self.log_db_rollup_query(rollup, handle + '.logs', where or '1 = 1'))
+        finally:
+            detach()
+
+    def log_db_create_snapshots(self):
+        """Create the snapshots table, and the table of the days which have their snapshots"""
+        self.execute("CREATE TABLE IF NOT EXISTS logs_snapshots (day INT, host_name VARCHAR(64), "
+                     "service_description VARCHAR(64), time INT, state INT)")
+        self.execute("CREATE INDEX IF NOT EXISTS logs_snapshots_object "
+                     "ON logs_snapshots (host_name, service_description, day)")
+        if not self.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='logs_snapshots_days'"):
+            self.execute("CREATE TABLE logs_snapshots_days (day INT PRIMARY KEY)")
+            self.execute("INSERT INTO logs_snapshots_days SELECT DISTINCT day FROM logs_snapshots")
+
+    def log_db_update_snapshots(self, handle, day):
+        """(Re)build the snapshots of a day from the states rollup of its attached archive"""
+        self.log_db_create_snapshots()
+        self.execute("DELETE FROM logs_snapshots WHERE day = %d" % day)
+        self.execute("INSERT INTO logs_snapshots (day, host_name, service_description, time, state) "
+                     "SELECT %d, host_name, service_description, last_time, last_state "
+                     "FROM %s.logs_day_states" % (day, handle))
+        self.execute("INSERT OR IGNORE INTO logs_snapshots_days (day) VALUES (%d)" % day)
+
+    def log_db_missing_snapshots(self, before):
+        """
+        Return the snapshots of the archived days before a time which have none, the archives
+        of a previous version: they are computed from their states rollup, and stored unless
+        the database is read only.
+        :param before: a unix timestamp
+        :return: a list of (day, host_name, service_description, time, state)
+        """
+        days = set()
+        if self.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='logs_snapshots_days'"):
+            days = set([day for day, in self.execute("SELECT day FROM logs_snapshots_days WHERE day < %d"
+                                                     % before)])
+        self.log_db_refresh_archive_index()
+        last = bisect.bisect_left(self.archive_starts, (before,))
+        missing = [(start, key) for start, key in self.archive_starts[:last] if start not in days]
+        if not missing:
+            return []
+
+        # The newest state of each host and service of a day, in all its archives
+        snapshots = {}
+        for start, key in missing:
+            _, handle, archive, _, _ = self.archive_index[key]['day']
+            for row in self.log_db_datafile_rollup('states', handle, archive):
+                snapshot = snapshots.get((start, row[0], row[1]))
+                if snapshot is None or snapshot[3] <= row[5]:
+                    snapshots[(start, row[0], row[1])] = (start, row[0], row[1], row[5], row[6])
+        rows = sorted(snapshots.values(), key=lambda row: row[0])
+        if not self.read_only:
+            self.log_db_create_snapshots()
+            starts = sorted(set([start for start, _ in missing]))
+            for start in starts:
+                self.execute("DELETE FROM logs_snapshots WHERE day = %d" % start)
+                self.execute("INSERT OR IGNORE INTO logs_snapshots_days (day) VALUES (%d)" % start)
+            self.dbcursor.executemany("INSERT INTO logs_snapshots (day, host_name, service_description, time, state) "
+                                      "VALUES (?, ?, ?, ?, ?)", rows)
             self.commit()
-            cmd = "ATTACH DATABASE '%s' AS %s" % (archive, handle)
-            self.execute_attach(cmd)
-            self._check_table_exist(handle)
-            cmd = "INSERT INTO %s.logs SELECT * FROM logs WHERE time >= %d AND time < %d" \
-                  % (handle, starttime, stoptime)
-            self.execute(cmd)
-            self.commit()
-            cmd = "SELECT count(*) FROM logs WHERE time >= %d AND time < %d" \
-                  % (starttime, stoptime)
-            result = self.execute(cmd)
-            log_count = result[0][0]
-
-            logger.info("[Logstore SQLite] moving %d logs from %s - %s to database %s", log_count,
-                        time.asctime(time.localtime(starttime)),
-                        time.asctime(time.localtime(stoptime)), archive)
-
-            cmd = "DELETE FROM logs WHERE time >= %d AND time < %d" \
-                  % (starttime, stoptime)
-            self.execute(cmd)
-            self.commit()
-            cmd = "DETACH DATABASE %s" % handle
-            self.execute(cmd)
-            self.commit()
+            logger.info("[Logstore SQLite] snapshots of %d archived days built", len(starts))
+        return rows
+
+    def get_log_states_at(self, at_time):
+        """
+        Return the last known state of each host and service before a time: the last
+        snapshot of the archived days before its day, updated with the alerts and
+        state logs of its day until the time.
+        :param at_time: a unix timestamp
+        :return: a dict (host_name, service_description) -> (time, state), service_description
+        is None for the hosts
+        """
+        # make the buffered log lines visible to this query
+        self.flush_ingest_buffer()
+
+        at_time = int(at_time)
+        day_start = int(time.mktime(datetime.date.fromtimestamp(at_time).timetuple()))
+        snapshots = {}
+        missing = self.log_db_missing_snapshots(day_start)
+        if self.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='logs_snapshots'"):
+            # The state and time columns are those of the row of the newest day
+            for host_name, service_description, day, last_time, state in self.execute(
+                    "SELECT host_name, service_description, MAX(day), time, state FROM logs_snapshots "
+                    "WHERE day < %d GROUP BY host_name, service_description" % day_start):
+                snapshots[(host_name, service_description)] = (day, last_time, state)
+        if self.read_only:
+            # The snapshots of the days which have none are not stored
+            for day, host_name, service_description, last_time, state in missing:
+                snapshot = snapshots.get((host_name, service_description))
+                if snapshot is None or snapshot[0] <= day:
+                    snapshots[(host_name, service_description)] = (day, last_time, state)
+        states = dict([(key, (last_time, state)) for key, (_, last_time, state) in snapshots.items()])
+        where = 'time >= %d AND time < %d' % (day_start, at_time)
+        for _, handle, archive, _, _ in self.log_db_relevant_files(day_start, at_time):
+            for row in self.log_db_datafile_rollup('states', handle, archive, where):
+                states[(row[0], row[1])] = (row[5], row[6])
+        return states
+
+    def log_db_expire_archives(self, max_files=0):
+        """
+        Delete the archives of the days older than max_logs_age days, or compress
+        them to the expired archives path. At most max_files archives are expired
+        per call, unless max_files is 0.
+        :return: True if some archives are still to expire
+        """
+        if not isinstance(self.max_logs_age, int) or self.max_logs_age <= 0:
+            # No retention
+            return False
 
-            # This is necessary to shrink the main database file
+        today = datetime.date.today()
+        oldest_day = datetime.datetime(today.year, today.month, today.day) \
+            - datetime.timedelta(days=self.max_logs_age)
+        self.log_db_refresh_archive_index()
+        expired = self.archive_starts[:bisect.bisect_left(self.archive_starts,
+                                                          (int(time.mktime(oldest_day.timetuple())),))]
+        for _, key in expired[:max_files or None]:
+            _, handle, archive, _, _ = self.archive_index[key]['day']
+            if self.attached_archives.get(handle) == archive:
+                self.detach_archive(handle)
+            self.log_db_evict_decompressed(archive)
             try:
+                if self.expired_archives_path and archive.endswith('.gz'):
+                    logger.info("[Logstore SQLite] moving the expired archive %s to %s",
+                                archive, self.expired_archives_path)
+                    if not os.path.exists(self.expired_archives_path):
+                        os.makedirs(self.expired_archives_path)
+                    shutil.move(archive, self.expired_archives_path)
+                elif self.expired_archives_path:
+                    self.log_db_compress_archive(archive, self.expired_archives_path)
+                else:
+                    logger.info("[Logstore SQLite] deleting the expired archive %s", archive)
+                    os.remove(archive)
+            except (IOError, OSError) as exp:
+                logger.error("[Logstore SQLite] can not expire the archive %s: %s", archive, str(exp))
+                return False
+            self.logs_tables.discard(archive)
+            self.fts_tables.discard(archive)
+            self.log_db_unindex_archive(key)
+        return 0 < max_files < len(expired)
+
+    def log_db_compress_archives(self, max_files=0):
+        """
+        Compress the archives of the days older than compress_archives_after days,
+        at most max_files archives per call, unless max_files is 0.
+        :return: True if some archives are still to compress
+        """
+        if self.compress_archives_after <= 0:
+            return False
+
+        today = datetime.date.today()
+        oldest_day = datetime.datetime(today.year, today.month, today.day) \
+            - datetime.timedelta(days=self.compress_archives_after)
+        self.log_db_refresh_archive_index()
+        oldest = bisect.bisect_left(self.archive_starts, (int(time.mktime(oldest_day.timetuple())),))
+        keys = [key for _, key in self.archive_starts[:oldest]
+                if not self.archive_index[key]['day'][2].endswith('.gz')]
+        for key in keys[:max_files or None]:
+            entry = self.archive_index[key]
+            _, handle, archive, _, _ = entry['day']
+            if archive not in self.logs_tables:
+                # Upgrade the schema now, it is not upgraded in the decompressed copies
+                detach = self.attach_archive(handle, archive)
+                self.log_db_check_archive(handle, archive)
+                detach()
+            if self.attached_archives.get(handle) == archive:
+                self.detach_archive(handle)
+            try:
+                self.log_db_compress_archive(archive, self.archive_path)
+            except (IOError, OSError) as exp:
+                logger.error("[Logstore SQLite] can not compress the archive %s: %s", archive, str(exp))
+                return False
+            self.logs_tables.discard(archive)
+            self.fts_tables.discard(archive)
+            entry['day'] = entry['day'][:2] + [archive + '.gz'] + entry['day'][3:]
+            entry['mtime'] = self.log_db_archive_mtime(archive + '.gz')
+        return 0 < max_files < len(keys)
+
+    def log_db_decompressed_archive(self, archive):
+        """
+        Return the decompressed copy of a compressed archive, decompressed in the cache
+        if it is not already there. The least recently used copies are deleted when the
+        cache is bigger than compressed_cache_size, except the returned one.
+        """
+        cached = self.compressed_cache.pop(archive, None)
+        if cached is not None and os.path.exists(cached[0]):
+            self.compressed_cache[archive] = cached
+            return cached[0]
+
+        if self.compressed_cache_dir is None:
+            if self.compressed_cache_path:
+                if not os.path.exists(self.compressed_cache_path):
+                    os.makedirs(self.compressed_cache_path)
+                self.compressed_cache_dir = self.compressed_cache_path
+            else:
+                self.compressed_cache_dir = tempfile.mkdtemp(prefix='livelogs-')
+        decompressed = os.path.join(self.compressed_cache_dir, os.path.basename(archive)[:-len('.gz')])
+        logger.debug("[Logstore SQLite] decompressing the archive %s", archive)
+        self.log_db_decompress_archive(archive, decompressed)
+        self.compressed_cache[archive] = (decompressed, os.path.getsize(decompressed))
+
+        size = sum([cached_size for _, cached_size in self.compressed_cache.values()])
+        for compressed in list(self.compressed_cache):
+            if size <= self.compressed_cache_size * 1024 * 1024 or compressed == archive:
+                break
+            size -= self.compressed_cache[compressed][1]
+            self.log_db_evict_decompressed(compressed)
+        return decompressed
+
+    def log_db_evict_decompressed(self, archive):
+        """Delete the decompressed copy of a compressed archive"""
+        cached = self.compressed_cache.pop(archive, None)
+        if cached is None:
+            return
+        for handle, attached in list(self.attached_archives.items()):
+            if attached == cached[0]:
+                self.detach_archive(handle)
+        self.logs_tables.discard(cached[0])
+        self.fts_tables.discard(cached[0])
+        try:
+            os.remove(cached[0])
+        except OSError:
+            pass
+
+    def log_db_clear_decompressed(self):
+        """Delete the cache of the decompressed archives, the connection is closed"""
+        for decompressed, _ in self.compressed_cache.values():
+            try:
+                os.remove(decompressed)
+            except OSError:
+                pass
+        self.compressed_cache.clear()
+        if self.compressed_cache_dir is not None and not self.compressed_cache_path:
+            shutil.rmtree(self.compressed_cache_dir, ignore_errors=True)
+        self.compressed_cache_dir = None
+
+    @staticmethod
+    def log_db_decompress_archive(compressed, archive):
+        """Decompress a compressed archive to the archive datafile"""
+        with gzip.open(compressed, 'rb') as source:
+            with open(archive + '.tmp', 'wb') as target:
+                shutil.copyfileobj(source, target)
+        os.rename(archive + '.tmp', archive)
+
+    @staticmethod
+    def log_db_compress_archive(archive, path):
+        """Compress an archive datafile to the path directory, then delete it"""
+        if not os.path.exists(path):
+            os.makedirs(path)
+        compressed = os.path.join(path, os.path.basename(archive) + '.gz')
+        logger.info("[Logstore SQLite] compressing the archive %s to %s", archive, compressed)
+        with open(archive, 'rb') as source:
+            with gzip.open(compressed + '.tmp', 'wb') as target:
+                shutil.copyfileobj(source, target)
+        os.rename(compressed + '.tmp', compressed)
+        os.remove(archive)
+
+    def log_db_vacuum(self, full=None):
+        """Shrink the main database file, incrementally unless full is True.
+        Default is the full VACUUM, except for the incremental vacuum mode"""
+        if full is None:
+            full = self.vacuum_mode != 'incremental'
+        try:
+            if full:
+                logger.info("[Logstore SQLite] vacuuming the database file...")
                 self.execute('VACUUM')
-            except sqlite3.DatabaseError as exp:
-                logger.error("[Logstore SQLite] WARNING: it seems your database is corrupted. "
-                             "Error=%s. Please recreate it", str(exp))
+                if self.database_file in self.fts_tables:
+                    # The VACUUM may change the rowids the full-text index refers to
+                    self.execute("INSERT INTO logs_fts(logs_fts) VALUES ('rebuild')")
+            else:
+                # Each step of this pragma frees one page, a script runs all the steps. A cursor
+                # of python 3 only runs the first one, the pragma does not return any row
+                self.commit()
+                self.dbconn.executescript('PRAGMA incremental_vacuum')
+        except (sqlite3.DatabaseError, LiveStatusLogStoreError) as exp:
+            logger.error("[Logstore SQLite] WARNING: it seems your database is corrupted. "
+                         "Error=%s. Please recreate it", str(exp))
+        self.commit()
+
+    def log_db_bulk_load(self, filenames, processes=0):
+        """
+        Load some log files, like the nagios-*.log archives of Nagios or Shinken,
+        in the datafiles of their days. The files are parsed by processes worker
+        processes (0: one per cpu) into staging datafiles without index, which are
+        merged in the order of the files into the archives of their days, or into
+        the current datafile for the logs of its day. The indexes, the rollups and
+        the snapshots of the loaded archives are built at the end.
+        The broker must not use the database during the load, which is faster with
+        the bulk-load performance profile.
+        :return: the number of loaded logs
+        """
+        try:
+            os.stat(self.archive_path)
+        except OSError:
+            logger.warning("Creating archive path: %s", self.archive_path)
+            os.mkdir(self.archive_path)
+
+        staging_path = tempfile.mkdtemp(prefix='bulk-load-', dir=self.archive_path)
+        jobs = [(filename, os.path.join(staging_path, 'staging-%d.db' % number))
+                for number, filename in enumerate(filenames)]
+        # archive -> day description of the loaded archives
+        loaded = {}
+        count = 0
+        # The indexes of the loaded archives are created once all the logs are loaded
+        indexes = self.log_db_indexes, self.fulltext_index
+        self.log_db_indexes, self.fulltext_index = (), False
+        pool = multiprocessing.Pool(processes or None)
+        try:
+            for filename, staging, parsed in pool.imap(bulk_parse_log_file, jobs):
+                logger.info("[LogStore SQLite] %d logs parsed from %s", parsed, filename)
+                count += self.log_db_bulk_merge(staging, loaded)
+                os.remove(staging)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+            self.log_db_indexes, self.fulltext_index = indexes
+            shutil.rmtree(staging_path, ignore_errors=True)
+
+        self.log_db_bulk_finish(loaded)
+        logger.info("[LogStore SQLite] %d logs loaded in %d archives", count, len(loaded))
+        return count
+
+    def log_db_bulk_merge(self, staging, loaded):
+        """Move the logs of a staging datafile to the datafiles of their days
+        :param loaded: archive -> day description of the loaded archives, updated
+        :return: the number of moved logs
+        """
+        self.commit()
+        self.execute_attach("ATTACH DATABASE '%s' AS staging" % staging)
+        try:
+            mintime, maxtime = self.execute("SELECT MIN(time), MAX(time) FROM staging.logs")[0]
+            if mintime is None:
+                return 0
+            count = 0
+            for day in self.log_db_relevant_files(mintime, maxtime, preview=True):
+                where = "time >= %d" % day[3]
+                if day[1] != "main":
+                    where += " AND time < %d" % day[4]
+                log_count = self.execute("SELECT COUNT(*) FROM staging.logs WHERE %s" % where)[0][0]
+                if not log_count:
+                    continue
+                detach = _do_nothing_lambda
+                if day[1] != "main":
+                    self.log_db_reopen_archive(day)
+                    detach = self.attach_archive(day[1], day[2])
+                    self.log_db_check_archive(day[1], day[2], create_if_not_exist=True)
+                    loaded[day[2]] = day
+                self.execute("INSERT INTO %s.logs (%s) SELECT %s FROM staging.logs WHERE %s"
+                             % (day[1], LOGS_SELECT_COLUMNS, LOGS_SELECT_COLUMNS, where))
+                count += log_count
+                self.commit()
+                detach()
+            return count
+        finally:
+            self.detach_archive('staging')
+
+    def log_db_bulk_finish(self, loaded):
+        """Create the indexes, the rollups and the snapshots of the loaded archives, and index them"""
+        for day in sorted(loaded.values(), key=lambda day: day[3]):
+            handle, archive = day[1], day[2]
+            detach = self.attach_archive(handle, archive)
+            self.create_log_db_indexes(handle + '.logs')
+            if self.fulltext_index:
+                self.create_log_db_fulltext_index(handle + '.logs')
+                self.fts_tables.add(archive)
+            self.log_db_build_rollups(handle)
+            self.log_db_update_snapshots(handle, day[3])
             self.commit()
+            detach()
+            self.log_db_index_archive(day)
 
     def select(self, cmd, values=None, a_row_factory=None, post_select=None):
         """Same function than execute but it returns a generator instead of a list.
@@ -441,6 +1894,24 @@ class LiveStatusLogStoreSqlite(BaseModule):
         :type a_row_factory: __builtin__.NoneType or __builtin__.function
         :return: a generator which yields one per one the rows of the selected values.
         """
+        if self.metrics is None:
+            return self._select(cmd, values, a_row_factory, post_select)
+        # The time spent in sqlite and in the row factory, without the time of the caller
+        if a_row_factory is not None:
+            a_row_factory = LiveStatusTimedRowFactory(a_row_factory)
+        return self.metrics.measure_iteration(self._select(cmd, values, a_row_factory, post_select),
+                                              partial(self.measured_select, a_row_factory), size=len)
+
+    def measured_select(self, a_row_factory, count, spent, _):
+        """The time spent in sqlite is sql, the time spent to build the rows is row_factory"""
+        self.metrics.count('rows_selected', count)
+        if a_row_factory is not None:
+            self.metrics.observe('row_factory', a_row_factory.spent)
+            spent -= a_row_factory.spent
+        self.metrics.observe('sql', spent)
+
+    def _select(self, cmd, values, a_row_factory, post_select):
+        """The generator of select()"""
         if values is None:
             values = []
 
@@ -462,8 +1933,7 @@ class LiveStatusLogStoreSqlite(BaseModule):
         finally:
             if a_row_factory:
                 self.dbcursor.close()
-                if orig_row_factory:
-                    self.dbconn.row_factory = orig_row_factory
+                self.dbconn.row_factory = orig_row_factory
                 self.dbcursor = self.make_cursor()
             if post_select:
                 post_select()
@@ -488,8 +1958,7 @@ class LiveStatusLogStoreSqlite(BaseModule):
                 dbresult = self.dbcursor.fetchall()
                 if a_row_factory:
                     self.dbcursor.close()
-                    if orig_row_factory:
-                        self.dbconn.row_factory = orig_row_factory
+                    self.dbconn.row_factory = orig_row_factory
                     self.dbcursor = self.make_cursor()
             else:
                 self.dbcursor.execute(cmd, values)
@@ -517,8 +1986,44 @@ class LiveStatusLogStoreSqlite(BaseModule):
         # else:
         self.dbcursor.execute(cmd)
 
+    def attach_archive(self, handle, archive):
+        """Attach an archive datafile to the connection, unless it is still attached.
+        When the attach cache is full, the least recently used archive is detached.
+        :return: the function to call when the archive is not used anymore
+        """
+        if self.attached_archives.get(handle) == archive:
+            # Most recently used
+            del self.attached_archives[handle]
+            self.attached_archives[handle] = archive
+            if self.metrics is not None:
+                self.metrics.count('attach_cache_hits')
+            return _do_nothing_lambda
+
+        if handle in self.attached_archives:
+            self.detach_archive(handle)
+        while self.attached_archives and len(self.attached_archives) >= self.attach_cache_size:
+            self.detach_archive(next(iter(self.attached_archives)))
+
+        self.commit()
+        start = time.time()
+        self.execute_attach("ATTACH DATABASE '%s' AS %s" % (archive, handle))
+        self.set_log_db_pragmas(self.dbconn, handle)
+        if self.metrics is not None:
+            self.metrics.observe('attach', time.time() - start)
+        if not self.attach_cache_size:
+            return partial(self.detach_archive, handle)
+        self.attached_archives[handle] = archive
+        return _do_nothing_lambda
+
+    def detach_archive(self, handle):
+        self.attached_archives.pop(handle, None)
+        self.commit()
+        self.execute("DETACH DATABASE %s" % handle)
+
     def commit(self):
         start = time.time()
+        self.flush_ingest_buffer()
+        waits = 0
         while True:
             try:
                 self.dbconn.commit()
@@ -528,7 +2033,12 @@ class LiveStatusLogStoreSqlite(BaseModule):
                 # than do an endless loop
                 if time.time() - start > 60:
                     raise
+                waits += 1
                 time.sleep(.01)
+        if self.metrics is not None:
+            self.metrics.observe('commit', time.time() - start)
+            if waits:
+                self.metrics.count('commit_waits', waits)
 
     def manage_log_brok(self, b):
         if self.read_only:
@@ -536,25 +2046,131 @@ class LiveStatusLogStoreSqlite(BaseModule):
 
         data = b.data
         line = data['log']
-        if re.match(r"^\[[0-9]*\] [A-Z][a-z]*.:", line):
+        if self.metrics is not None:
+            self.metrics.count('broks')
+        if IGNORED_LOG_LINE.match(line):
             # Match log which NOT have to be stored
             # print "Unexpected in manage_log_brok", line
             return
 
+        if self.writer is not None:
+            self.writer.put(line)
+            return
+        self.manage_log_line(line)
+        # FIXME need access to this #self.livestatus.count_event('log_message')
+
+    def manage_log_line(self, line):
+        """Parse a log line and buffer it for the next insertion"""
         try:
             logline = Logline(line=line)
-            values = logline.as_tuple()
             if logline.logclass != LOGCLASS_INVALID:
-                self.execute('INSERT INTO LOGS VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
-        except LiveStatusLogStoreError as exp:
-            logger.error("[Logstore SQLite] A DB error occurred: %s", str(exp))
+                if not self.ingest_buffer:
+                    self.ingest_buffer_since = time.time()
+                self.ingest_buffer.append(logline.as_tuple())
         except Exception as exp:
             logger.error("[Logstore SQLite] Unexpected in manage_log_brok: %s", str(exp))
-        # FIXME need access to this #self.livestatus.count_event('log_message')
+
+        if len(self.ingest_buffer) >= self.ingest_buffer_size or self.ingest_buffer_expired():
+            self.commit()
+
+    def get_writer_stats(self):
+        """Return the writer thread counters, an empty dict in inline mode"""
+        if self.writer is None:
+            return {}
+        return self.writer.get_stats()
+
+    def get_metrics(self):
+        """Return a snapshot of the metrics, with the ones of the writer thread, an empty dict if they are disabled"""
+        if self.metrics is None:
+            return {}
+        metrics = self.metrics.get()
+        if self.writer is not None and self.writer.store is not None and self.writer.store.metrics is not None:
+            metrics['writer'] = self.writer.store.metrics.get()
+        return metrics
+
+    def log_metrics(self):
+        """Log a summary of the metrics since the previous one"""
+        metrics = self.get_metrics()
+        last, self.metrics_logged = self.metrics_logged, metrics
+        logger.info("[LogStore SQLite] metrics: %s", format_metrics(metrics, last))
+        if 'writer' in metrics:
+            logger.info("[LogStore SQLite] writer metrics: %s",
+                        format_metrics(metrics['writer'], last and last.get('writer')))
+
+    def ingest_buffer_expired(self, now=None):
+        """Return True if the oldest buffered log line waits for too long"""
+        if not self.ingest_buffer:
+            return False
+        if now is None:
+            now = time.time()
+        return now - self.ingest_buffer_since >= self.ingest_buffer_max_age
+
+    def flush_ingest_buffer(self):
+        """Insert all the buffered log lines with a single statement.
+
+        The rows are not committed here, commit() calls this function
+        so that a flush and its commit happen in the same transaction.
+        A row which can not be inserted (IntegrityError, DataError) is lost.
+        On the other errors, like a locked database, the rows which are not
+        inserted stay in the buffer, they are inserted again after
+        ingest_buffer_max_age, and lost after ingest_buffer_retries tries.
+        :return: the number of inserted rows
+        """
+        start = time.time()
+        if not self.ingest_buffer or self.dbconn is None or start < self.ingest_retry_at:
+            return 0
+
+        buffered = self.ingest_buffer
+        since = self.ingest_buffer_since
+        self.ingest_buffer = []
+        self.ingest_buffer_since = None
+        inserted = 0
+        while buffered:
+            # The rows are counted as they are inserted, a statement stops at its failing row
+            position = [0]
+
+            def counted(rows):
+                for row in rows:
+                    position[0] += 1
+                    yield row
+
+            try:
+                rows = buffered
+                if self.logs_data_table == 'logs_data':
+                    rows = [self.log_db_encode_row(row) for row in rows]
+                self.dbcursor.executemany(INSERT_LOGS_QUERY % self.logs_data_table, counted(rows))
+                inserted += len(buffered)
+                buffered = []
+                self.ingest_failures = 0
+            except (sqlite3.IntegrityError, sqlite3.DataError) as exp:
+                failed = max(position[0] - 1, 0)
+                logger.error("[Logstore SQLite] A DB error occurred, 1 log line lost: %s", str(exp))
+                self.log_dictionary.clear()
+                inserted += failed
+                buffered = buffered[failed + 1:]
+            except sqlite3.Error as exp:
+                failed = max(position[0] - 1, 0)
+                self.log_dictionary.clear()
+                inserted += failed
+                buffered = buffered[failed:]
+                self.ingest_failures += 1
+                if self.ingest_failures > self.ingest_buffer_retries:
+                    logger.error("[Logstore SQLite] A DB error occurred, %d log lines lost: %s",
+                                 len(buffered), str(exp))
+                    self.ingest_failures = 0
+                else:
+                    logger.warning("[Logstore SQLite] A DB error occurred, %d log lines kept for a retry: %s",
+                                   len(buffered), str(exp))
+                    self.ingest_buffer = buffered
+                    self.ingest_buffer_since = since
+                    self.ingest_retry_at = time.time() + self.ingest_buffer_max_age
+                break
+        if self.metrics is not None:
+            self.metrics.observe('insert', time.time() - start)
+            self.metrics.count('rows_inserted', inserted)
+        return inserted
 
     def add_filter(self, operator, attribute, reference):
-        if attribute == 'time':
-            self.sql_time_filter_stack.put_stack(self.make_sql_filter(operator, attribute, reference))
         self.sql_filter_stack.put_stack(self.make_sql_filter(operator, attribute, reference))
 
     def add_filter_and(self, andnum):
@@ -566,54 +2182,378 @@ class LiveStatusLogStoreSqlite(BaseModule):
     def add_filter_not(self):
         self.sql_filter_stack.not_elements()
 
+    def set_columns(self, columns, filtercolumns=()):
+        """
+        Projects the next query on the columns needed by the requested columns and by the
+        columns of the python filters, the other columns of the logs table are selected as NULL.
+        No columns or an unknown column selects all the columns.
+        :param columns: the Columns: of the livestatus query
+        :param filtercolumns: the columns of its Filter: and Stats: headers
+        """
+        needed = set(LOGS_KEY_COLUMNS)
+        for column in list(columns) + list(filtercolumns):
+            if column in LOGS_COLUMNS:
+                needed.add(column)
+            elif column.startswith('current_'):
+                needed.update(LOGS_FILL_COLUMNS)
+            else:
+                needed = None
+                break
+        if not columns or needed is None:
+            self.select_columns = LOGS_SELECT_COLUMNS
+        else:
+            self.select_columns = ', '.join([column if column in needed else 'NULL AS %s' % column
+                                             for column in LOGS_COLUMNS])
+
+    def set_limit(self, limit, newest_first=False):
+        """
+        Limits the number of rows of the next query and sets their order. The limit is
+        only pushed down to the datafiles when the sql filter is exact, that is when the
+        python filters can not drop any of the selected rows, else it is left to the caller.
+        :param limit: the Limit: of the livestatus query, None for no limit
+        :param newest_first: the datafiles and their rows are queried from the newest to the oldest
+        """
+        self.limit = None if limit is None else int(limit)
+        self.newest_first = newest_first
+
     def get_live_data_log(self):
         """
         :return: a generator which yields the results one per one.
         """
-        # finalize the filter stacks
-        self.sql_time_filter_stack.and_elements(self.sql_time_filter_stack.qsize())
-        self.sql_filter_stack.and_elements(self.sql_filter_stack.qsize())
-        if self.use_aggressive_sql:
-            # Be aggressive, get preselected data from sqlite and do less
-            # filtering in python. But: only a subset of Filter:-attributes
-            # can be mapped to columns in the logs-table, for the others
-            # we must use "always-true"-clauses. This can result in
-            # funny and potentially ineffective sql-statements
-            sql_filter_func = self.sql_filter_stack.get_stack()
-        else:
+        if self.metrics is None:
+            return self._get_live_data_log()
+        self.metrics.count('queries')
+        return self.metrics.measure_iteration(self._get_live_data_log(), self.measured_query)
+
+    def measured_query(self, count, spent, elapsed):
+        """The time spent by the caller of a query, eg. in the python filters of livestatus, is query_consumer"""
+        self.metrics.count('rows_yielded', count)
+        self.metrics.observe('query', spent)
+        self.metrics.observe('query_consumer', elapsed - spent)
+
+    def _get_live_data_log(self):
+        # make the buffered log lines visible to this query
+        self.flush_ingest_buffer()
+
+        # the projection, the limit and the order are set for one query only
+        columns, self.select_columns = self.select_columns, LOGS_SELECT_COLUMNS
+        limit, newest_first = self.limit, self.newest_first
+        self.limit, self.newest_first = None, False
+
+        # finalize the filter stack
+        sql_filter = self.sql_filter_stack.get_filter()
+        if not (self.use_aggressive_sql and sql_filter.exact):
+            limit = None
+        # A timerange can be useful for a faster preselection of lines,
+        # it is computed from the whole filter (ANDs intersect, ORs unite)
+        from_time, to_time = sql_filter.time_range()
+        # Be aggressive, get preselected data from sqlite and do less
+        # filtering in python. But: only a subset of Filter:-attributes
+        # can be mapped to columns in the logs-table, for the others
+        # we must use "always-true"-clauses. This can result in
+        # funny and potentially ineffective sql-statements
+        if not self.use_aggressive_sql:
             # Be conservative, get everything from the database between
             # two dates and apply the Filter:-clauses in python
-            sql_filter_func = self.sql_time_filter_stack.get_stack()
+            sql_filter = LiveStatusSqlTimeFilter(from_time, to_time)
 
         # We can apply the filterstack here as well. we have columns and filtercolumns.
         # the only additional step is to enrich log lines with host/service-attributes
-        # A timerange can be useful for a faster preselection of lines
-        filter_clause, filter_values = sql_filter_func()
-        full_filter_clause = filter_clause
-        matchcount = 0
-        for _ in re.finditer(r"\?", full_filter_clause):
-            full_filter_clause = re.sub('\\?', str(filter_values[matchcount]), full_filter_clause, 1)
-            matchcount += 1
-        from_time = 0
-        to_time = int(time.time()) + 1
-        gt_pattern = re.search(r'^(\(*time|(.*\s+time))\s+>\s+(\d+)', full_filter_clause)
-        ge_pattern = re.search(r'^(\(*time|(.*\s+time))\s+>=\s+(\d+)', full_filter_clause)
-        lt_pattern = re.search(r'^(\(*time|(.*\s+time))\s+<\s+(\d+)', full_filter_clause)
-        le_pattern = re.search(r'^(\(*time|(.*\s+time))\s+<=\s+(\d+)', full_filter_clause)
-        if gt_pattern is not None:
-            from_time = int(gt_pattern.group(3)) + 1
-        if ge_pattern is not None:
-            from_time = int(ge_pattern.group(3))
-        if lt_pattern is not None:
-            to_time = int(lt_pattern.group(3)) - 1
-        if le_pattern is not None:
-            to_time = int(le_pattern.group(3))
-
-        for _, handle, archive, from_time, to_time in self.log_db_relevant_files(from_time, to_time):
-            rows_gen = self.select_live_data_log(filter_clause, filter_values, handle, archive, from_time, to_time)
-            for rows in rows_gen:
-                for row in rows:
-                    yield row
+        if from_time is None:
+            from_time = self.log_db_oldest_time()
+        if to_time is None:
+            to_time = int(time.time()) + 1
+        if from_time > to_time:
+            # Nothing can match
+            return
+
+        days = self.log_db_relevant_files(from_time, to_time)
+        order = ''
+        if newest_first:
+            days.reverse()
+            order = ' ORDER BY time DESC'
+        elif limit is not None:
+            order = ' ORDER BY time'
+        # The archives are queried by the workers, except the compressed ones which are
+        # decompressed one after the other. The current datafile is queried on the main connection.
+        # With a limit, the datafiles are queried one after the other until it is reached
+        for parallel, group in groupby(days, lambda day: bool(self.query_workers) and limit is None
+                                       and day[1] != "main" and not day[2].endswith('.gz')):
+            if parallel:
+                for rows in self.select_live_data_log_parallel(sql_filter, list(group), columns, order):
+                    for row in rows:
+                        yield row
+                continue
+            for _, handle, archive, from_time, to_time in group:
+                if limit is None:
+                    rows_gen = self.select_live_data_log(sql_filter, handle, archive, from_time, to_time,
+                                                         columns, order)
+                elif limit > 0:
+                    rows_gen = self.select_live_data_log(sql_filter, handle, archive, from_time, to_time,
+                                                         columns, order + ' LIMIT %d' % limit)
+                else:
+                    return
+                for rows in rows_gen:
+                    if limit is not None:
+                        limit -= len(rows)
+                    for row in rows:
+                        yield row
+
+    def get_live_data_log_stats(self, stats, group_by=()):
+        """
+        Computes simple Stats: of the log table in SQL: each datafile computes its partial
+        results with a GROUP BY, they are merged. Only the exact sql filters can be computed
+        in SQL, else the filter is put back on the stack for get_live_data_log.
+        :param stats: a list of (function, column), function is count, sum, min or max,
+        the column of count may be None
+        :param group_by: the columns the stats are grouped by
+        :return: the sorted list of the group values followed by the stats values, one per
+        group, or None if the stats can not be computed in SQL
+        """
+        for function, column in stats:
+            if function not in STATS_FUNCTIONS or (column is not None and column not in LOGS_COLUMNS):
+                raise LiveStatusLogStoreError("Unsupported stats: %s %s" % (function, column))
+        for column in group_by:
+            if column not in LOGS_COLUMNS:
+                raise LiveStatusLogStoreError("Unsupported stats group: %s" % column)
+
+        # make the buffered log lines visible to this query
+        self.flush_ingest_buffer()
+
+        # the projection, the limit and the order are set for one query only
+        query_state = self.select_columns, self.limit, self.newest_first
+        self.select_columns, self.limit, self.newest_first = LOGS_SELECT_COLUMNS, None, False
+
+        sql_filter = self.sql_filter_stack.get_filter()
+        if not (self.use_aggressive_sql and sql_filter.exact):
+            # They are left for get_live_data_log with the filter
+            self.sql_filter_stack.put_stack(sql_filter)
+            self.select_columns, self.limit, self.newest_first = query_state
+            return None
+        from_time, to_time = sql_filter.time_range()
+        if from_time is None:
+            from_time = self.log_db_oldest_time()
+        if to_time is None:
+            to_time = int(time.time()) + 1
+
+        columns = ', '.join(list(group_by) + ['%s(%s)' % (function.upper(), column or '*')
+                                              for function, column in stats])
+        group_clause = ' GROUP BY %s' % ', '.join(group_by) if group_by else ''
+        keys = len(group_by)
+        results = {}
+        if from_time <= to_time:
+            for _, handle, archive, day_from, day_to in self.log_db_relevant_files(from_time, to_time):
+                for rows in self.select_live_data_log(sql_filter, handle, archive, day_from, day_to,
+                                                      columns, group_clause, tuple_row_factory):
+                    for row in rows:
+                        key, values = row[:keys], row[keys:]
+                        merged = results.get(key)
+                        if merged is not None:
+                            values = [merge_stats(function, a, b) for (function, _), a, b in zip(stats, merged, values)]
+                        results[key] = tuple(values)
+        if not group_by and not results:
+            results[()] = tuple([0 if function == 'count' else None for function, _ in stats])
+        # the NULL groups first
+        return sorted([key + values for key, values in results.items()],
+                      key=lambda row: [(value is not None, value) for value in row[:keys]])
+
+    def select_live_data_log_parallel(self, sql_filter, days, columns=LOGS_SELECT_COLUMNS, order=''):
+        """
+        Returns a generator which yields rows per rows from several archives.
+        The archives are queried at the same time by the query_workers threads
+        of the pool, each archive on its own read-only connection. The rows are
+        yielded archive after archive, in the order of the days, and at most
+        query_prefetch chunks of rows are buffered for each archive.
+        """
+        self.start_query_workers()
+        cancel = threading.Event()
+        # (rows queue, result cache key, cached result) of the days
+        results = []
+        for day in days:
+            key = self.log_db_result_key(day, sql_filter, columns, order)
+            cached = self.result_cache.get(key) if key is not None else None
+            if self.metrics is not None:
+                self.metrics.count('archives_queried')
+                if key is not None:
+                    self.metrics.count('result_cache_hits' if cached is not None else 'result_cache_misses')
+            if cached is not None:
+                results.append((None, key, cached))
+                continue
+            result = queue.Queue(maxsize=self.query_prefetch)
+            if key is not None:
+                # The workers fetch the rows as tuples to be cached
+                cached = LiveStatusCachedResult(self.result_cache.max_memory)
+                a_row_factory = cached
+            else:
+                a_row_factory = self.make_row_factory()
+            self.query_jobs.put((day[2], result, a_row_factory, cancel, sql_filter, columns, order))
+            results.append((result, key, cached))
+
+        try:
+            for result, key, cached in results:
+                if result is None:
+                    for rows in cached.fetch(self.make_row_factory()):
+                        yield rows
+                    continue
+                a_row_factory = self.make_row_factory()
+                while True:
+                    rows = self.get_query_result(result)
+                    if rows is None:
+                        break
+                    if isinstance(rows, Exception):
+                        logger.error("[Logstore SQLite] An error occurred: %s", str(rows))
+                        raise LiveStatusLogStoreError(rows)
+                    if cached is not None:
+                        cached.add(rows)
+                        rows = [a_row_factory(cached, row) for row in rows]
+                    yield rows
+                if cached is not None:
+                    self.result_cache.put(key, cached)
+        finally:
+            # Stop the jobs of this query if the caller does not want more rows
+            cancel.set()
+
+    def start_query_workers(self):
+        """Start the threads of the query workers pool which are not running"""
+        self.query_threads = [worker for worker in self.query_threads if worker.is_alive()]
+        while len(self.query_threads) < self.query_workers:
+            worker = threading.Thread(target=self._query_worker, name='logstore-sqlite-query')
+            worker.daemon = True
+            worker.start()
+            self.query_threads.append(worker)
+
+    def stop_query_workers(self):
+        for _ in self.query_threads:
+            self.query_jobs.put(None)
+        for worker in self.query_threads:
+            worker.join(QUERY_WORKER_TIMEOUT)
+        self.query_threads = []
+
+    def get_query_result(self, result):
+        """Wait for the next chunk of rows of an archive, as long as the query workers are running"""
+        while True:
+            try:
+                return result.get(timeout=QUERY_WORKER_TIMEOUT)
+            except queue.Empty:
+                if not [worker for worker in self.query_threads if worker.is_alive()]:
+                    raise LiveStatusLogStoreError("the query workers are not running")
+
+    def _query_worker(self):
+        """Query worker: query the archives of the jobs queue, until a None job"""
+        while True:
+            job = self.query_jobs.get()
+            if job is None:
+                return
+            self._query_archive(*job)
+
+    def _query_archive(self, archive, result, a_row_factory, cancel, sql_filter, columns, order):
+        """Query an archive, its chunks of rows, or the exception, are put in the result queue,
+        followed by None in any case, unless the query is cancelled"""
+        def put(rows):
+            while not cancel.is_set():
+                try:
+                    result.put(rows, timeout=.1)
+                    return
+                except queue.Full:
+                    pass
+
+        if cancel.is_set():
+            return
+        try:
+            dbconn = sqlite3.connect(archive, cached_statements=self.statement_cache_size)
+            try:
+                dbconn.text_factory = str
+                dbconn.execute("PRAGMA query_only = 1")
+                self.set_log_db_pragmas(dbconn)
+                if dbconn.execute("SELECT name FROM sqlite_master "
+                                  "WHERE type IN ('table', 'view') AND name='logs'").fetchone():
+                    fts_schema = None
+                    if self.fulltext_index and dbconn.execute("SELECT name FROM sqlite_master WHERE "
+                                                              "type='table' AND name='logs_fts'").fetchone():
+                        fts_schema = 'main'
+                    filter_clause, filter_values = sql_filter(fts_schema)
+                    if self.metrics is not None:
+                        a_row_factory = LiveStatusTimedRowFactory(a_row_factory)
+                    dbconn.row_factory = a_row_factory
+                    cursor = dbconn.cursor()
+                    cursor.arraysize = self.CURSOR_ARRAYSIZE
+                    rows_gen = self._fetch_archive(cursor, cancel, 'SELECT %s FROM logs WHERE %s%s'
+                                                   % (columns, filter_clause, order), filter_values)
+                    if self.metrics is not None:
+                        rows_gen = self.metrics.measure_iteration(
+                            rows_gen, partial(self.measured_select, a_row_factory), size=len)
+                    for rows in rows_gen:
+                        put(rows)
+            finally:
+                dbconn.close()
+        except Exception as exp:
+            # Not only the sqlite errors, eg. an error of the row factory, the consumer raises it
+            put(exp)
+        finally:
+            put(None)
+
+    @staticmethod
+    def _fetch_archive(cursor, cancel, cmd, values):
+        """Query worker: yield the chunks of rows of a statement until the query is cancelled"""
+        cursor.execute(cmd, values)
+        while not cancel.is_set():
+            rows = cursor.fetchmany()
+            if not rows:
+                break
+            yield rows
+
+    def log_db_oldest_time(self):
+        """Return the start of the oldest datafile"""
+        self.log_db_refresh_archive_index()
+        oldest = [int(time.time())]
+        if self.archive_starts:
+            oldest.append(self.archive_starts[0][0])
+        if self.archive_days:
+            oldest.append(self.archive_days[0][3])
+        return min(oldest)
+
+    @staticmethod
+    def make_sql_time_filter(from_time, to_time):
+        """Return the clause and values selecting a time range"""
+        clauses = []
+        values = []
+        if from_time is not None:
+            clauses.append('time >= ?')
+            values.append(from_time)
+        if to_time is not None:
+            clauses.append('time <= ?')
+            values.append(to_time)
+        if not clauses:
+            return ["1 = ?", [1]]
+        return ['(' + ' AND '.join(clauses) + ')', values]
+
+    def log_db_check_archive(self, handle, archive, create_if_not_exist=False):
+        """Check if an attached datafile contains the logs table, only the first
+        time it is attached. The missing indexes of the profile, and the full-text
+        index when it is enabled, are then created, except in the decompressed copies
+        of the compressed archives: the archives are upgraded before their compression.
+        :return: True if the logs table exists
+        """
+        if archive in self.logs_tables:
+            return True
+        if not self._check_table_exist(handle, create_if_not_exist) and not create_if_not_exist:
+            return False
+        if not self.read_only and not self.log_db_is_decompressed(archive):
+            if self.storage_schema == 'compact':
+                self.create_log_db_compact_schema(handle)
+            self.create_log_db_indexes(handle + '.logs')
+            if self.fulltext_index:
+                self.create_log_db_fulltext_index(handle + '.logs')
+            self.commit()
+        if self.fulltext_index and tuple(self.select("SELECT name FROM %s.sqlite_master "
+                                                     "WHERE type='table' AND name='logs_fts'" % handle)):
+            self.fts_tables.add(archive)
+        self.logs_tables.add(archive)
+        return True
+
+    def log_db_is_decompressed(self, datafile):
+        """Return True if the datafile is the decompressed copy of a compressed archive"""
+        return datafile in [decompressed for decompressed, _ in self.compressed_cache.values()]
 
     def _check_table_exist(self, handle='main', create_if_not_exist=True):
         """ Check if the table "logs" does exist in the 'handle' sqlite db namespace.
@@ -622,127 +2562,546 @@ class LiveStatusLogStoreSqlite(BaseModule):
         :param create_if_not_exist:
         :return: True if the database existed. False otherwise.
         """
-        res = tuple(self.select("SELECT name FROM %s.sqlite_master WHERE type='table' AND name='logs'" % handle))
+        res = tuple(self.select("SELECT name FROM %s.sqlite_master "
+                                "WHERE type IN ('table', 'view') AND name='logs'" % handle))
         if not res and create_if_not_exist:
             self.prepare_log_db_table(handle + '.logs')
         return bool(res)
 
-    # pylint: disable=unused-argument
-    def select_live_data_log(self, filter_clause, filter_values, handle, archive, fromtime, totime):
+    def select_live_data_log(self, sql_filter, handle, archive, fromtime, totime,
+                             columns=LOGS_SELECT_COLUMNS, order='', a_row_factory=None):
         """
         Returns a generator which yields rows per rows.
-        :param filter_clause:
-        :param filter_values:
+        :param sql_filter: the LiveStatusSqlFilter of the query
         :param handle:
         :param archive:
-        :param fromtime:
-        :param totime:
+        :param fromtime: the start of the datafile
+        :param totime: the end of the datafile
+        :param columns: the select list of the query
+        :param order: the GROUP BY, ORDER BY and LIMIT clauses of the query
+        :param a_row_factory: the row factory of the query, make_row_factory() by default
         :return:
         """
+        a_row_factory = a_row_factory or self.make_row_factory()
+        key = None
+        if handle != "main":
+            key = self.log_db_result_key([None, handle, archive, fromtime, totime], sql_filter, columns, order)
+            cached = self.result_cache.get(key) if key is not None else None
+            if self.metrics is not None:
+                self.metrics.count('archives_queried')
+                if key is not None:
+                    self.metrics.count('result_cache_hits' if cached is not None else 'result_cache_misses')
+            if cached is not None:
+                return cached.fetch(a_row_factory)
         clean = _do_nothing_lambda
         try:
+            if archive.endswith('.gz'):
+                try:
+                    archive = self.log_db_decompressed_archive(archive)
+                except (IOError, OSError) as exp:
+                    raise LiveStatusLogStoreError(exp)
             if handle != "main":
-                self.commit()
-                self.execute_attach("ATTACH DATABASE '%s' AS %s" % (archive, handle))
-                clean = partial(self.execute, "DETACH DATABASE %s" % handle)
-            if not self._check_table_exist(handle, create_if_not_exist=False):
+                clean = self.attach_archive(handle, archive)
+            if not self.log_db_check_archive(handle, archive):
                 clean()
                 return []
-            return self.select('SELECT * FROM %s.logs WHERE %s' % (handle, filter_clause),
-                               filter_values, row_factory, post_select=clean)
+            filter_clause, filter_values = sql_filter(handle if archive in self.fts_tables else None)
+            cmd = 'SELECT %s FROM %s.logs WHERE %s%s' % (columns, handle, filter_clause, order)
+            if key is not None:
+                cached = LiveStatusCachedResult(self.result_cache.max_memory)
+                return self.log_db_cache_result(key, cached, self.select(cmd, filter_values, cached,
+                                                                         post_select=clean), a_row_factory)
+            return self.select(cmd, filter_values, a_row_factory, post_select=clean)
         except LiveStatusLogStoreError as exp:
             logger.error("[Logstore SQLite] An error occurred: %s", str(exp))
             raise
 
+    def log_db_result_key(self, day, sql_filter, columns, order):
+        """
+        Return the key of the results of a query of an archive in the result cache,
+        None if there is no cache or the archive does not exist anymore. The time
+        bounds of the filter which cover the whole archive are left out of the key.
+        """
+        if self.result_cache is None:
+            return None
+        try:
+            stat = os.stat(day[2])
+        except OSError:
+            return None
+        return day[2], stat.st_mtime, stat.st_size, columns, order, sql_filter.cache_key(day[3], day[4] - 1)
+
+    def log_db_cache_result(self, key, cached, rows_gen, a_row_factory):
+        """Yields the rows of a query while they are kept, they are cached when all are fetched"""
+        for rows in rows_gen:
+            cached.add(rows)
+            yield [a_row_factory(cached, row) for row in rows]
+        self.result_cache.put(key, cached)
+
+    def make_row_factory(self):
+        """Returns the row factory of a new statement"""
+        if self.light_rows:
+            return LiveStatusLogRowFactory()
+        return row_factory
+
     def make_sql_filter(self, operator, attribute, reference):
         # The filters are text fragments which are put together to form a sql where-condition finally.
-        # Add parameter Class (Host, Service), lookup datatype (default string), convert reference
+        # The plan of a filter, its clause and the parameter of its reference, only depends on its
+        # operator, its attribute and whether the reference is empty: it is computed once
+        key = (operator, attribute, reference == '')
+        plan = self.sql_filter_plans.get(key)
+        if plan is None:
+            plan = self.sql_filter_plans[key] = self.make_sql_filter_plan(*key)
+        clause, parameter = plan
+        if clause is None:
+            return LiveStatusSqlFilter('1 = 1', ())
+        if self.fulltext_index and attribute in FULLTEXT_COLUMNS and operator in ('~', '~~', '!~', '!~~') \
+                and len(reference) >= FULLTEXT_MIN_LENGTH and not REGEX_SPECIAL_CHARS.search(reference):
+            return LiveStatusSqlTextFilter(attribute, operator, reference, clause, parameter)
+        return LiveStatusSqlColumnFilter(attribute, operator, reference, clause, parameter)
+
+    @staticmethod
+    def make_sql_filter_plan(operator, attribute, empty_reference):
+        """
+        Return the clause of a filter and the function computing the parameter of its
+        reference, None if there is no parameter, or (None, None) if the filter can not
+        be done in SQL.
+        """
         # which attributes are suitable for a sql statement
         good_attributes = ['time', 'attempt', 'class', 'command_name', 'comment', 'contact_name',
-                           'host_name', 'plugin_output', 'service_description', 'state', 'state_type', 'type']
-        # good_operators = ['=', '!=']
-
-        def eq_filter():
-            if reference == '':
-                return ['%s IS NULL' % attribute, ()]
-
-            return ['%s = ?' % attribute, (reference,)]
-
-        def match_filter():
-            # sqlite matches case-insensitive by default. We make
-            # no difference between case-sensitive and case-insensitive
-            # here. The python filters will care for the correct
-            # matching later.
-            return ['%s LIKE ?' % attribute, ('%' + reference + '%',)]
-
-        def eq_nocase_filter():
-            if reference == '':
-                return ['%s IS NULL' % attribute, ()]
-
-            return ['%s = ?' % attribute.lower(), (reference.lower(),)]
-
-        def match_nocase_filter():
-            return ['%s LIKE ?' % attribute, ('%' + reference + '%',)]
-
-        def lt_filter():
-            return ['%s < ?' % attribute, (reference,)]
-
-        def gt_filter():
-            return ['%s > ?' % attribute, (reference,)]
-
-        def le_filter():
-            return ['%s <= ?' % attribute, (reference,)]
-
-        def ge_filter():
-            return ['%s >= ?' % attribute, (reference,)]
-
-        def ne_filter():
-            if reference == '':
-                return ['%s IS NOT NULL' % attribute, ()]
-
-            return ['%s != ?' % attribute, (reference,)]
-
-        def not_match_filter():
-            return ['NOT %s LIKE ?' % attribute, ('%' + reference + '%',)]
-
-        def ne_nocase_filter():
-            if reference == '':
-                return ['NOT %s IS NULL' % attribute, ()]
-
-            return ['NOT %s = ?' % attribute.lower(), (reference.lower(),)]
-
-        def not_match_nocase_filter():
-            return ['NOT %s LIKE ?' % attribute, ('%' + reference + '%',)]
-
-        def no_filter():
-            return ['1 = 1', ()]
-
-        if attribute not in good_attributes:
-            return no_filter
-        if operator == '=':
-            return eq_filter
-        elif operator == '~':
-            return match_filter
-        elif operator == '=~':
-            return eq_nocase_filter
-        elif operator == '~~':
-            return match_nocase_filter
-        elif operator == '<':
-            return lt_filter
-        elif operator == '>':
-            return gt_filter
-        elif operator == '<=':
-            return le_filter
-        elif operator == '>=':
-            return ge_filter
-        elif operator == '!=':
-            return ne_filter
-        elif operator == '!~':
-            return not_match_filter
-        elif operator == '!=~':
-            return ne_nocase_filter
-        elif operator == '!~~':
-            return not_match_nocase_filter
+                           'host_name', 'message', 'plugin_output', 'service_description', 'state',
+                           'state_type', 'type']
+        if attribute not in good_attributes or operator not in SQL_FILTER_TEMPLATES:
+            return None, None
+        clause, empty_clause, parameter = SQL_FILTER_TEMPLATES[operator]
+        if empty_reference and empty_clause is not None:
+            return empty_clause % attribute, None
+        return clause % attribute, parameter
+
+
+class LiveStatusLogStoreWriter(threading.Thread):
+    """Store the log lines in the database from a dedicated thread.
+
+    The broker main thread only puts the raw log lines in a bounded queue. This
+    thread owns another LiveStatusLogStoreSqlite, with its own sqlite connection,
+    which parses, inserts, commits and rotates the database.
+    When the queue is full, the overflow policy is applied:
+    - block: wait until the writer thread makes some room,
+    - drop_oldest: forget the oldest queued line,
+    - spill: append the line to a file which is replayed when the queue is empty,
+      the next lines are spilled too until it is replayed so that the lines are
+      stored in order.
+    If the thread is not running, eg. the database could not be opened, the lines
+    are spilled with the spill policy, else dropped.
+    """
+
+    def __init__(self, modconf, queue_size, overflow_policy, spill_file):
+        threading.Thread.__init__(self, name='logstore-sqlite-writer')
+        self.daemon = True
+        self.modconf = modconf
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflow_policy = overflow_policy
+        self.spill_file = spill_file
+        # Protects the spill file and the spilling flag, they change together
+        self.spill_lock = threading.Lock()
+        # some lines are in the spill file or being replayed, the next ones are spilled too
+        self.spilling = overflow_policy == 'spill' and os.path.exists(spill_file)
+        self.store = None
+
+        self.max_depth = 0
+        self.queued = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.written = 0
+
+    def put(self, line):
+        """Queue a log line, called from the broker main thread"""
+        if self.overflow_policy == 'spill':
+            # The line is queued or spilled while the writer thread can not start or end a replay
+            with self.spill_lock:
+                if self.spilling or not self.is_alive():
+                    self.spill_line(line)
+                    return
+                try:
+                    self.queue.put_nowait(line)
+                except queue.Full:
+                    self.spill_line(line)
+                    return
+        elif not self.is_alive():
+            self.dropped += 1
+            return
+        elif self.overflow_policy == 'block':
+            while True:
+                try:
+                    self.queue.put(line, timeout=WRITER_PUT_TIMEOUT)
+                    break
+                except queue.Full:
+                    if not self.is_alive():
+                        self.dropped += 1
+                        return
+        else:
+            try:
+                self.queue.put_nowait(line)
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(line)
+                except queue.Full:
+                    self.dropped += 1
+                    return
+        self.queued += 1
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def spill_line(self, line):
+        """Append a log line to the spill file, called with the spill lock"""
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+        with open(self.spill_file, 'ab') as spill_file:
+            spill_file.write(line.rstrip() + b'\n')
+        self.spilling = True
+        self.spilled += 1
+
+    def replay_spill_file(self):
+        """
+        Store the log lines spilled to disk, called when the queue is empty. The lines
+        spilled during the replay are replayed next, the next lines are queued only
+        when the spill file is drained.
+        """
+        replay_file = self.spill_file + '.replay'
+        while True:
+            with self.spill_lock:
+                if not os.path.exists(self.spill_file):
+                    self.spilling = False
+                    return
+                os.rename(self.spill_file, replay_file)
+
+            logger.info("[Logstore SQLite] replaying the spilled log lines from %s", self.spill_file)
+            with open(replay_file, 'rb') as spill_file:
+                for line in spill_file:
+                    if not isinstance(line, str):
+                        line = line.decode('utf-8')
+                    self.store.manage_log_line(line.rstrip())
+                    self.written += 1
+            os.remove(replay_file)
+
+    def get_stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_max_depth': self.max_depth,
+            'queue_size': self.queue.maxsize,
+            'queued': self.queued,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'written': self.written,
+        }
+
+    def stop(self):
+        """Stop the thread once all the queued log lines are stored"""
+        while self.is_alive():
+            try:
+                self.queue.put(None, timeout=WRITER_PUT_TIMEOUT)
+                break
+            except queue.Full:
+                pass
+        self.join()
+
+    def run(self):
+        try:
+            self.store = LiveStatusLogStoreSqlite(self.modconf)
+            self.store.writer_mode = 'inline'
+            # The broker store logs the metrics of this one
+            self.store.metrics_log_interval = 0
+            self.store.open()
+            self.store.prepare_log_db_table()
+        except Exception as exp:
+            logger.error("[Logstore SQLite] The writer thread can not open the database: %s", str(exp))
+            return
+        logger.info("[Logstore SQLite] writer thread started")
+
+        while True:
+            try:
+                line = self.queue.get(timeout=1)
+            except queue.Empty:
+                line = ''
+            if line is None:
+                break
+
+            try:
+                if line:
+                    self.store.manage_log_line(line)
+                    self.written += 1
+                if self.overflow_policy == 'spill' and self.queue.empty():
+                    self.replay_spill_file()
+                self.store.commit_and_rotate_log_db()
+            except Exception as exp:
+                logger.error("[Logstore SQLite] Unexpected in the writer thread: %s", str(exp))
+
+        try:
+            if self.overflow_policy == 'spill':
+                self.replay_spill_file()
+            self.store.close()
+        except Exception as exp:
+            logger.error("[Logstore SQLite] Unexpected when stopping the writer thread: %s", str(exp))
+        logger.info("[Logstore SQLite] writer thread stopped")
+
+
+def bulk_parse_log_file(job):
+    """
+    Parse a log file into a staging datafile, in a worker process of log_db_bulk_load.
+    The log file is read line by line, it may be gzipped. The logs table of the staging
+    datafile has no index and it is written with the bulk-load pragmas.
+    :param job: (log file, staging datafile)
+    :return: (log file, staging datafile, number of parsed logs)
+    """
+    filename, staging = job
+    dbconn = sqlite3.connect(staging)
+    dbconn.text_factory = str
+    for name, value in PERFORMANCE_PROFILES['bulk-load'].items():
+        dbconn.execute("PRAGMA %s = %s" % (name, value)).fetchall()
+    dbconn.execute("CREATE TABLE logs (%s)" % ', '.join(['%s %s' % column for column in LOGS_COLUMN_TYPES]))
+
+    count = 0
+    rows = []
+    # The line numbers of the file
+    Logline.lineno = 0
+    log_file = gzip.open(filename, 'rb') if filename.endswith('.gz') else open(filename, 'rb')
+    try:
+        for line in log_file:
+            if not isinstance(line, str):
+                line = line.decode('utf-8', 'replace')
+            line = line.rstrip()
+            if not line or IGNORED_LOG_LINE.match(line):
+                continue
+            try:
+                logline = Logline(line=line)
+            except Exception as exp:
+                logger.warning("[Logstore SQLite] Ignoring a line of %s: %s", filename, str(exp))
+                continue
+            if logline.logclass == LOGCLASS_INVALID:
+                continue
+            rows.append(logline.as_tuple())
+            if len(rows) >= DEFAULT_BULK_LOAD_BATCH_SIZE:
+                dbconn.executemany(INSERT_LOGS_QUERY % 'logs', rows)
+                count += len(rows)
+                rows = []
+        dbconn.executemany(INSERT_LOGS_QUERY % 'logs', rows)
+        count += len(rows)
+        dbconn.commit()
+    finally:
+        log_file.close()
+        dbconn.close()
+    return filename, staging, count
+
+
+class LiveStatusSqlFilter(object):
+    """A node of the filter tree built by LiveStatusSqlStack.
+
+    Calling a filter returns its where-clause and the values of its parameters.
+    time_range() returns the (from, to) interval of the time column implied by
+    the filter, each bound being None when the filter does not limit it.
+    exact is True when the python filter can not drop any of the selected rows.
+    The clause only depends on the shape of the filter, its structure, and the
+    values on its references: plan() returns the clause and the functions computing
+    the values from the references, None when a value is its reference.
+    cache_key() identifies the rows selected in a datafile of a time range.
+    """
+
+    def __init__(self, clause, values, exact=False):
+        self.clause = clause
+        self.values = list(values)
+        # the clause selects exactly the rows matched by the python filter
+        self.exact = exact
+        self.shape = ('sql', clause, len(self.values))
+        self.references = tuple(self.values)
+
+    def __call__(self, fts_schema=None):
+        """:param fts_schema: the schema of the queried logs table if it has a full-text index"""
+        if self.clause is None:
+            self.set_plan(self.plan())
+        return [self.clause, self.values]
+
+    def plan(self):
+        return self.clause, [None] * len(self.references)
+
+    def set_plan(self, plan):
+        """Set the clause of a plan of the shape of the filter and compute the values of its references"""
+        self.clause, parameters = plan
+        self.values = [reference if parameter is None else parameter(reference)
+                       for parameter, reference in zip(parameters, self.references)]
+
+    def time_range(self):
+        return None, None
+
+    def cache_key(self, start, end):
+        return self.shape, self.references
+
+
+class LiveStatusSqlTimeFilter(LiveStatusSqlFilter):
+    """The time range of a query, the other filters are applied in python"""
+
+    def __init__(self, from_time, to_time):
+        LiveStatusSqlFilter.__init__(self, *LiveStatusLogStoreSqlite.make_sql_time_filter(from_time, to_time))
+        self.from_time = from_time
+        self.to_time = to_time
+
+    def time_range(self):
+        return self.from_time, self.to_time
+
+    def cache_key(self, start, end):
+        # the bounds outside of the datafile do not select other rows
+        if (self.from_time is None or self.from_time <= start) and (self.to_time is None or self.to_time >= end):
+            return ALL_ROWS_CACHE_KEY
+        return ('time',
+                None if self.from_time is None or self.from_time <= start else self.from_time,
+                None if self.to_time is None or self.to_time >= end else self.to_time)
+
+
+class LiveStatusSqlColumnFilter(LiveStatusSqlFilter):
+    """A filter comparing a column of the logs table to a reference"""
+
+    def __init__(self, attribute, operator, reference, clause, parameter):
+        # a NULL column is selected by the empty references, not by the python filters
+        exact_operator = operator in EXACT_FILTER_OPERATORS or (attribute == 'time' and operator in ('<', '<='))
+        exact = reference != '' and exact_operator
+        values = () if parameter is None else (parameter(reference),)
+        LiveStatusSqlFilter.__init__(self, clause, values, exact=exact)
+        self.attribute = attribute
+        self.operator = operator
+        self.reference = reference
+        self.parameter = parameter
+        self.shape = (operator, attribute, reference == '')
+        self.references = () if parameter is None else (reference,)
+
+    def plan(self):
+        return self.clause, [] if self.parameter is None else [self.parameter]
+
+    def time_range(self):
+        if self.attribute != 'time':
+            return None, None
+        try:
+            reference = int(self.reference)
+        except (TypeError, ValueError):
+            return None, None
+        return {
+            '=': (reference, reference),
+            '>': (reference + 1, None),
+            '>=': (reference, None),
+            '<': (None, reference - 1),
+            '<=': (None, reference),
+        }.get(self.operator, (None, None))
+
+    def cache_key(self, start, end):
+        low, high = self.time_range()
+        if (low, high) != (None, None) and (low is None or low <= start) and (high is None or high >= end):
+            # the bound selects all the rows of the datafile
+            return ALL_ROWS_CACHE_KEY
+        return LiveStatusSqlFilter.cache_key(self, start, end)
+
+
+class LiveStatusSqlTextFilter(LiveStatusSqlColumnFilter):
+    """A substring match of a text column, searched in the full-text index when it exists"""
+
+    def __call__(self, fts_schema=None):
+        if fts_schema is None:
+            return [self.clause, self.values]
+        # A phrase of the trigram tokenizer matches the substrings, case-insensitive like LIKE
+        phrase = '%s : "%s"' % (self.attribute, self.reference.replace('"', '""'))
+        return ['%srowid IN (SELECT rowid FROM %s.logs_fts WHERE logs_fts MATCH ?)'
+                % ('NOT ' if self.operator.startswith('!') else '', fts_schema), [phrase]]
+
+
+class LiveStatusSqlBooleanFilter(LiveStatusSqlFilter):
+    """The filters joined by the operator, their clause is only built from their plans"""
+
+    operator = None
+
+    def __init__(self, filters):
+        LiveStatusSqlFilter.__init__(self, None, (), exact=all([x.exact for x in filters]))
+        self.filters = filters
+        self.shape = (self.operator,) + tuple([x.shape for x in filters])
+        self.references = tuple([reference for x in filters for reference in x.references])
+
+    def __call__(self, fts_schema=None):
+        if fts_schema is None:
+            return LiveStatusSqlFilter.__call__(self)
+        return join_sql_filters(' %s ' % self.operator, [x(fts_schema) for x in self.filters])
+
+    def plan(self):
+        plans = [x.plan() for x in self.filters]
+        return ('(' + (' %s ' % self.operator).join([clause for clause, _ in plans]) + ')',
+                [parameter for _, parameters in plans for parameter in parameters])
+
+
+class LiveStatusSqlAndFilter(LiveStatusSqlBooleanFilter):
+    """All the filters must match, their time ranges intersect"""
+
+    operator = 'AND'
+
+    def time_range(self):
+        ranges = [x.time_range() for x in self.filters]
+        lows = [low for low, _ in ranges if low is not None]
+        highs = [high for _, high in ranges if high is not None]
+        return max(lows) if lows else None, min(highs) if highs else None
+
+    def cache_key(self, start, end):
+        keys = [key for key in [x.cache_key(start, end) for x in self.filters] if key != ALL_ROWS_CACHE_KEY]
+        if not keys:
+            return ALL_ROWS_CACHE_KEY
+        return keys[0] if len(keys) == 1 else (self.operator,) + tuple(keys)
+
+
+class LiveStatusSqlOrFilter(LiveStatusSqlBooleanFilter):
+    """One of the filters must match, the time range covers all of theirs"""
+
+    operator = 'OR'
+
+    def time_range(self):
+        ranges = [x.time_range() for x in self.filters]
+        lows = [low for low, _ in ranges]
+        highs = [high for _, high in ranges]
+        return (None if None in lows else min(lows)), (None if None in highs else max(highs))
+
+    def cache_key(self, start, end):
+        keys = [x.cache_key(start, end) for x in self.filters]
+        if ALL_ROWS_CACHE_KEY in keys:
+            return ALL_ROWS_CACHE_KEY
+        return (self.operator,) + tuple(keys)
+
+
+class LiveStatusSqlNotFilter(LiveStatusSqlFilter):
+    """The filter must not match, the time range is not bounded"""
+
+    def __init__(self, sql_filter):
+        LiveStatusSqlFilter.__init__(self, None, ())
+        self.filter = sql_filter
+        self.shape = ('NOT', sql_filter.shape)
+        self.references = sql_filter.references
+
+    def __call__(self, fts_schema=None):
+        if fts_schema is None:
+            return LiveStatusSqlFilter.__call__(self)
+        clause, values = self.filter(fts_schema)
+        return ['(NOT ' + clause + ')', values]
+
+    def plan(self):
+        clause, parameters = self.filter.plan()
+        return '(NOT ' + clause + ')', parameters
+
+    def cache_key(self, start, end):
+        return 'NOT', self.filter.cache_key(start, end)
+
+
+def join_sql_filters(operator, clauses):
+    """Join the [clause, values] of several filters with AND or OR"""
+    values = []
+    for _, filter_values in clauses:
+        values.extend(filter_values)
+    return ['(' + operator.join([clause for clause, _ in clauses]) + ')', values]
 
 
 class LiveStatusSqlStack(LiveStatusStack):
@@ -750,13 +3109,24 @@ class LiveStatusSqlStack(LiveStatusStack):
     def __init__(self, *args, **kw):
         self.type = 'sql'
         self.__class__.__bases__[0].__init__(self, *args, **kw)
+        # shape of the whole filter of a query -> plan, its clause and the parameters of its references
+        self.plans = {}
+
+    def get_filter(self):
+        """Return the filter of the query, all the filters of the stack anded. The plan
+        of its shape is computed once, only the values of its references are computed"""
+        self.and_elements(self.qsize())
+        sql_filter = self.get_stack()
+        plan = self.plans.get(sql_filter.shape)
+        if plan is None:
+            if len(self.plans) >= SQL_STACK_PLANS_SIZE:
+                self.plans.clear()
+            plan = self.plans[sql_filter.shape] = sql_filter.plan()
+        sql_filter.set_plan(plan)
+        return sql_filter
 
     def not_elements(self):
-        top_filter = self.get_stack()
-        negate_clause = '(NOT ' + top_filter()[0] + ')'
-        negate_values = top_filter()[1]
-        negate_filter = lambda: [negate_clause, negate_values]
-        self.put_stack(negate_filter)
+        self.put_stack(LiveStatusSqlNotFilter(self.get_stack()))
 
     def and_elements(self, num):
         """Take num filters from the stack, and them and put the result back"""
@@ -765,12 +3135,10 @@ class LiveStatusSqlStack(LiveStatusStack):
             for _ in range(num):
                 filters.append(self.get_stack())
             # Take from the stack:
-            # Make a combined anded function
+            # Make a combined anded filter
             # Put it on the stack
-            and_clause = '(' + (' AND ').join([x()[0] for x in filters]) + ')'
-            and_values = reduce(lambda x, y: x + y, [x()[1] for x in filters])
-            and_filter = lambda: [and_clause, and_values]
-            logger.debug("[Logstore SQLite] and_elements %s, %s", and_clause, and_values)
+            and_filter = LiveStatusSqlAndFilter(filters)
+            logger.debug("[Logstore SQLite] and_elements %s", and_filter.shape)
             self.put_stack(and_filter)
 
     def or_elements(self, num):
@@ -779,14 +3147,12 @@ class LiveStatusSqlStack(LiveStatusStack):
             filters = []
             for _ in range(num):
                 filters.append(self.get_stack())
-            or_clause = '(' + (' OR ').join([x()[0] for x in filters]) + ')'
-            or_values = reduce(lambda x, y: x + y, [x()[1] for x in filters])
-            or_filter = lambda: [or_clause, or_values]
-            logger.debug("[Logstore SQLite] or_elements: %s", or_clause)
+            or_filter = LiveStatusSqlOrFilter(filters)
+            logger.debug("[Logstore SQLite] or_elements: %s", or_filter.shape)
             self.put_stack(or_filter)
 
     def get_stack(self):
         """Return the top element from the stack or a filter which is always true"""
         if self.qsize():
             return self.get()
-        return lambda: ["1 = ?", [1]]
+        return LiveStatusSqlFilter("1 = ?", [1], exact=True)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the logstore: a synthetic history of log lines is stored with
+manage_log_brok, the past days are moved to their archives and some typical
+queries are timed, with the aggressive and the conservative SQL.
+
+The past days of the history only depend on the seed and on the python version,
+so two runs with the same parameters store the same logs. The results are written
+in JSON, eg. to compare a change:
+
+    python benchmark_logstore.py --days 7 --lines-per-day 200000 --output before.json
+    python benchmark_logstore.py --days 7 --lines-per-day 200000 --output after.json --compare before.json
+
+The module options are given with -o, eg. -o performance_profile=fast -o index_profile=full.
+It runs with the PYTHONPATH of run_tests.sh.
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import datetime
+import platform
+import tempfile
+import sqlite3
+from optparse import OptionParser
+
+from shinken.brok import Brok
+from shinken.objects.module import Module
+from shinken.modulesctx import modulesctx
+
+
+LiveStatusLogStoreSqlite = modulesctx.get_module('logstore-sqlite').LiveStatusLogStoreSqlite
+
+# Version of the format of the results
+RESULTS_VERSION = 1
+
+SERVICE_STATES = ('OK', 'WARNING', 'CRITICAL', 'UNKNOWN')
+HOST_STATES = ('UP', 'DOWN', 'UNREACHABLE')
+OUTPUTS = ('OK - all is fine', 'connection timeout after 10 seconds', 'disk usage is 91%',
+           'load average: 4.12, 3.80, 3.02', 'No route to host', 'HTTP 503 Service Unavailable')
+
+# Queries: name -> filters, from the benchmark time window (start, end) and a sample host and service
+QUERIES = (
+    ('host', lambda start, end, host, service: [('>=', 'time', start), ('=', 'host_name', host)]),
+    ('host_service', lambda start, end, host, service: [('>=', 'time', start), ('=', 'host_name', host),
+                                                        ('=', 'service_description', service)]),
+    ('time_window', lambda start, end, host, service: [('>=', 'time', end - 3600), ('<=', 'time', end)]),
+    ('last_day_alerts', lambda start, end, host, service: [('>=', 'time', end - 86400), ('=', 'class', '1')]),
+    ('like_search', lambda start, end, host, service: [('>=', 'time', end - 86400),
+                                                       ('~', 'plugin_output', 'timeout')]),
+)
+
+
+def host_name(number):
+    return 'host_%04d' % number
+
+
+def service_description(number):
+    return 'service_%02d' % number
+
+
+def generate_day(rand, day_start, lines, hosts, services):
+    """Return the sorted log lines of a day: the current states at its start, then the
+    alerts, the notifications and the external commands of the day"""
+    day = []
+    for host in range(hosts):
+        day.append((day_start, "CURRENT HOST STATE: %s;UP;HARD;1;%s" % (host_name(host), OUTPUTS[0])))
+    for _ in range(max(lines - hosts, 0)):
+        line_time = day_start + rand.randint(1, 86399)
+        host = host_name(rand.randrange(hosts))
+        service = service_description(rand.randrange(services))
+        output = rand.choice(OUTPUTS)
+        kind = rand.random()
+        if kind < 0.70:
+            line = "SERVICE ALERT: %s;%s;%s;%s;%d;%s" % (
+                host, service, rand.choice(SERVICE_STATES), rand.choice(('SOFT', 'HARD')), rand.randint(1, 3), output)
+        elif kind < 0.80:
+            line = "HOST ALERT: %s;%s;%s;%d;%s" % (
+                host, rand.choice(HOST_STATES), rand.choice(('SOFT', 'HARD')), rand.randint(1, 3), output)
+        elif kind < 0.95:
+            line = "SERVICE NOTIFICATION: admin;%s;%s;%s;notify-service-by-email;%s" % (
+                host, service, rand.choice(SERVICE_STATES[1:]), output)
+        else:
+            line = "EXTERNAL COMMAND: ACKNOWLEDGE_SVC_PROBLEM;%s;%s;1;1;0;admin;on it" % (host, service)
+        day.append((line_time, line))
+    day.sort(key=lambda line: line[0])
+    return ["[%d] %s" % line for line in day]
+
+
+def log_brok(line):
+    """Return the log brok of a line, unserialized as the broker does before giving it to the modules"""
+    brok = Brok('log', {'log': line})
+    brok.prepare()
+    return brok
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def run_query(store, filters, aggressive):
+    store.use_aggressive_sql = aggressive
+    for operator, attribute, reference in filters:
+        store.add_filter(operator, attribute, str(reference))
+    if len(filters) > 1:
+        store.add_filter_and(len(filters))
+    return len(list(store.get_live_data_log()))
+
+
+def benchmark(opts, module_options, work_path):
+    rand = random.Random(opts.seed)
+    conf = {
+        'module_name': 'LogStore',
+        'module_type': 'logstore_sqlite',
+        'database_file': os.path.join(work_path, 'livelogs.db'),
+        'archive_path': os.path.join(work_path, 'archives'),
+        'max_logs_age': str(opts.days + 1),
+    }
+    conf.update(module_options)
+    store = LiveStatusLogStoreSqlite(Module(conf))
+    store.open()
+    store.prepare_log_db_table()
+    results = {}
+
+    # Ingestion of the past days and of today until now
+    today = datetime.date.today()
+    today_start = int(time.mktime(today.timetuple()))
+    now = int(time.time())
+    count = 0
+    elapsed = 0.0
+    for days_ago in range(opts.days, -1, -1):
+        day_start = int(time.mktime((today - datetime.timedelta(days=days_ago)).timetuple()))
+        lines = generate_day(rand, day_start, opts.lines_per_day, opts.hosts, opts.services)
+        if day_start == today_start:
+            lines = [line for line in lines if int(line[1:line.index(']')]) <= now]
+        broks = [log_brok(line) for line in lines]
+        start = time.time()
+        for brok in broks:
+            store.manage_log_brok(brok)
+        store.commit()
+        elapsed += time.time() - start
+        count += len(broks)
+    results['ingest'] = {'rows': count, 'seconds': elapsed, 'rows_per_second': count / elapsed if elapsed else 0}
+    sys.stderr.write("ingest: %d logs in %.2fs\n" % (count, elapsed))
+
+    # Move of the past days to their archives
+    _, elapsed = timed(store.log_db_do_archive)
+    archived = count - store.execute("SELECT COUNT(*) FROM logs")[0][0]
+    results['archive'] = {
+        'rows': archived,
+        'seconds': elapsed,
+        'rows_per_second': archived / elapsed if elapsed else 0,
+    }
+    sys.stderr.write("archive: %d logs in %.2fs\n" % (archived, elapsed))
+
+    # Queries, the first run opens the archives
+    queries = []
+    window_start = today_start - opts.days * 86400
+    for name, make_filters in QUERIES:
+        filters = make_filters(window_start, now, host_name(0), service_description(0))
+        for aggressive in (True, False):
+            timings = []
+            rows = 0
+            for _ in range(opts.repeat):
+                rows, elapsed = timed(run_query, store, filters, aggressive)
+                timings.append(elapsed)
+            timings.sort()
+            queries.append({'name': name, 'aggressive': aggressive, 'rows': rows,
+                            'min': timings[0], 'median': timings[len(timings) // 2], 'max': timings[-1]})
+            sys.stderr.write("query %s (%s): %d logs in %.4fs\n"
+                             % (name, 'aggressive' if aggressive else 'conservative', rows, timings[0]))
+    results['queries'] = queries
+
+    store.close()
+    return results
+
+
+def compare(results, previous):
+    """Print the speedup of each result, compared with the results of a previous run"""
+    for phase in ('ingest', 'archive'):
+        if phase in previous['results'] and results[phase]['seconds']:
+            speedup = previous['results'][phase]['seconds'] / results[phase]['seconds']
+            sys.stderr.write("%s: x%.2f\n" % (phase, speedup))
+    previous_queries = dict([((query['name'], query['aggressive']), query)
+                             for query in previous['results'].get('queries', [])])
+    for query in results['queries']:
+        before = previous_queries.get((query['name'], query['aggressive']))
+        if before and query['median']:
+            mode = 'aggressive' if query['aggressive'] else 'conservative'
+            sys.stderr.write("query %s (%s): x%.2f\n" % (query['name'], mode, before['median'] / query['median']))
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-d', '--days', dest='days', type='int', default=7,
+                      help="Number of past days of the history, archived")
+    parser.add_option('-l', '--lines-per-day', dest='lines_per_day', type='int', default=100000,
+                      help="Number of log lines of each day")
+    parser.add_option('--hosts', dest='hosts', type='int', default=1000, help="Number of hosts")
+    parser.add_option('--services', dest='services', type='int', default=20, help="Number of services per host")
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3, help="Runs of each query")
+    parser.add_option('-s', '--seed', dest='seed', type='int', default=1, help="Seed of the history")
+    parser.add_option('-o', '--option', dest='options', action='append', default=[],
+                      help="Option of the module, name=value")
+    parser.add_option('--output', dest='output', default='benchmark_logstore.json', help="JSON results file")
+    parser.add_option('--compare', dest='compare', help="JSON results of a previous run")
+    parser.add_option('--work-path', dest='work_path', help="Directory of the databases, kept after the run")
+    opts, _ = parser.parse_args()
+    module_options = dict([option.split('=', 1) for option in opts.options])
+
+    work_path = opts.work_path or tempfile.mkdtemp(prefix='benchmark-logstore-')
+    if not os.path.exists(work_path):
+        os.makedirs(work_path)
+    try:
+        results = benchmark(opts, module_options, work_path)
+    finally:
+        if not opts.work_path:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    report = {
+        'version': RESULTS_VERSION,
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'parameters': {'days': opts.days, 'lines_per_day': opts.lines_per_day, 'hosts': opts.hosts,
+                       'services': opts.services, 'repeat': opts.repeat, 'seed': opts.seed},
+        'options': module_options,
+        'results': results,
+    }
+    with open(opts.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    if opts.compare:
+        with open(opts.compare) as previous:
+            compare(results, json.load(previous))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -33,6 +33,8 @@ import shutil
 import time
 import random
 import copy
+import gzip
+import threading
 
 import pytest
 import sqlite3
@@ -56,6 +58,13 @@ LiveStatusRegenerator = livestatus_broker.LiveStatusRegenerator
 LiveStatusQueryCache = livestatus_broker.LiveStatusQueryCache
 Logline = livestatus_broker.Logline
 LiveStatusLogStoreSqlite = modulesctx.get_module('logstore-sqlite').LiveStatusLogStoreSqlite
+LiveStatusSqlStack = modulesctx.get_module('logstore-sqlite').LiveStatusSqlStack
+LiveStatusLogRowFactory = modulesctx.get_module('logstore-sqlite').LiveStatusLogRowFactory
+row_factory = modulesctx.get_module('logstore-sqlite').row_factory
+LiveStatusLogResultCache = modulesctx.get_module('logstore-sqlite').LiveStatusLogResultCache
+LiveStatusLogStoreMetrics = modulesctx.get_module('logstore-sqlite').LiveStatusLogStoreMetrics
+LiveStatusLogStoreError = modulesctx.get_module('logstore-sqlite').LiveStatusLogStoreError
+LiveStatusLogStoreWriter = modulesctx.get_module('logstore-sqlite').LiveStatusLogStoreWriter
 
 
 from mock_livestatus import mock_livestatus_handle_request
@@ -421,6 +430,11 @@ Columns: time type options state host_name"""
         # Only today's logs
         self.save_and_query_db(logs_count=logs_today, archives=True)
 
+        # The archives are indexed with their logs count
+        db = self.livestatus_broker.db
+        self.assertEqual(4, len(db.archive_starts))
+        self.assertEqual([6, 14, 22, 30], [db.archive_index[key]['count'] for _, key in db.archive_starts])
+
         request = """GET log
         Filter: time >= """ + str(int(back4days_morning)) + """
         Filter: time <= """ + str(int(back2days_noon)) + """
@@ -551,6 +565,921 @@ Columns: time type options state host_name"""
         print("lengths is: %s" % lengths)
         self.assertEqual([12, 28, 44, 60], lengths)
 
+    def test_ingest_buffer(self):
+        self.print_header()
+        host = self.sched.hosts.find_by_name("test_host_0")
+        db = self.livestatus_broker.db
+        db.commit()
+        logs_count = db.execute("SELECT COUNT(*) FROM logs")[0][0]
+
+        # Big buffer, no flush until a commit
+        db.ingest_buffer_size = 1000
+        db.ingest_buffer_max_age = 3600
+        self.write_logs(host, 2)
+        self.assertEqual(4, len(db.ingest_buffer))
+        numlogs = db.execute("SELECT COUNT(*) FROM logs")
+        self.assertEqual(logs_count, numlogs[0][0])
+
+        db.commit()
+        self.assertEqual([], db.ingest_buffer)
+        numlogs = db.execute("SELECT COUNT(*) FROM logs")
+        self.assertEqual(logs_count + 4, numlogs[0][0])
+
+        # Small buffer, flushed when it is full
+        db.ingest_buffer_size = 2
+        self.write_logs(host, 2)
+        self.assertEqual([], db.ingest_buffer)
+        numlogs = db.execute("SELECT COUNT(*) FROM logs")
+        self.assertEqual(logs_count + 8, numlogs[0][0])
+
+        # A locked database keeps the buffered lines, they are inserted by a retry
+        now = int(time.time())
+        db.execute("PRAGMA busy_timeout = 0")
+        locker = sqlite3.connect(db.database_file)
+        locker.execute("BEGIN IMMEDIATE")
+        db.manage_log_line("[%d] HOST ALERT: test_host_0;DOWN;HARD;1;Locked 1" % now)
+        db.manage_log_line("[%d] HOST ALERT: test_host_0;UP;HARD;1;Locked 2" % now)
+        self.assertEqual(2, len(db.ingest_buffer))
+        self.assertEqual(1, db.ingest_failures)
+        # no retry before the buffer max age
+        db.commit()
+        self.assertEqual(2, len(db.ingest_buffer))
+        self.assertEqual(1, db.ingest_failures)
+        locker.rollback()
+        db.ingest_retry_at = 0
+        db.commit()
+        self.assertEqual([], db.ingest_buffer)
+        self.assertEqual(0, db.ingest_failures)
+        self.assertEqual(logs_count + 10, db.execute("SELECT COUNT(*) FROM logs")[0][0])
+
+        # They are lost after the retries
+        db.ingest_buffer_retries = 1
+        locker.execute("BEGIN IMMEDIATE")
+        db.manage_log_line("[%d] HOST ALERT: test_host_0;DOWN;HARD;1;Lost 1" % now)
+        db.manage_log_line("[%d] HOST ALERT: test_host_0;UP;HARD;1;Lost 2" % now)
+        self.assertEqual(2, len(db.ingest_buffer))
+        db.ingest_retry_at = 0
+        db.commit()
+        self.assertEqual([], db.ingest_buffer)
+        locker.rollback()
+        locker.close()
+        db.execute("PRAGMA busy_timeout = 5000")
+        self.assertEqual(logs_count + 10, db.execute("SELECT COUNT(*) FROM logs")[0][0])
+
+    def test_sql_filter_time_range(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        stack = LiveStatusSqlStack()
+        # (time >= 100 AND time <= 200) OR (host_name = test_host_0 AND time > 300 AND time < 400)
+        stack.put_stack(db.make_sql_filter('>=', 'time', '100'))
+        stack.put_stack(db.make_sql_filter('<=', 'time', '200'))
+        stack.and_elements(2)
+        stack.put_stack(db.make_sql_filter('=', 'host_name', 'test_host_0'))
+        stack.put_stack(db.make_sql_filter('>', 'time', '300'))
+        stack.put_stack(db.make_sql_filter('<', 'time', '400'))
+        stack.and_elements(3)
+        stack.or_elements(2)
+        sql_filter = stack.get_stack()
+        self.assertEqual((100, 399), sql_filter.time_range())
+        clause, values = sql_filter()
+        self.assertEqual(5, clause.count('?'))
+        self.assertEqual(5, len(values))
+
+        # Not bounded
+        stack.put_stack(db.make_sql_filter('>=', 'time', '100'))
+        stack.put_stack(db.make_sql_filter('=', 'host_name', 'test_host_0'))
+        stack.or_elements(2)
+        self.assertEqual((None, None), stack.get_stack().time_range())
+        stack.put_stack(db.make_sql_filter('>=', 'time', '100'))
+        stack.not_elements()
+        self.assertEqual((None, None), stack.get_stack().time_range())
+        # Empty stack
+        self.assertEqual((None, None), stack.get_stack().time_range())
+
+    def test_index_profile(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        indexes = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+        self.assertIn('logs_time', indexes)
+        self.assertIn('logs_host_name_service_description_time', indexes)
+        self.assertIn('logs_class_time', indexes)
+
+        db.log_db_indexes = [('time',), ('host_name', 'time'), ('type', 'time')]
+        db.create_log_db_indexes()
+        indexes = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+        self.assertIn('logs_host_name_time', indexes)
+        self.assertIn('logs_type_time', indexes)
+
+    def test_fulltext_filter(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        fulltext_index = db.fulltext_index
+        db.fulltext_index = True
+        stack = LiveStatusSqlStack()
+        stack.put_stack(db.make_sql_filter('~', 'plugin_output', 'disk "full"'))
+        stack.put_stack(db.make_sql_filter('~', 'message', 'a.*b'))
+        stack.put_stack(db.make_sql_filter('>=', 'time', '100'))
+        stack.and_elements(3)
+        sql_filter = stack.get_stack()
+        db.fulltext_index = fulltext_index
+
+        # Without a full-text index, LIKE filters
+        clause, values = sql_filter()
+        self.assertEqual(2, clause.count('LIKE'))
+        # The regular expression is not searched in the full-text index
+        clause, values = sql_filter('db20130101')
+        self.assertEqual(1, clause.count('LIKE'))
+        self.assertIn('rowid IN (SELECT rowid FROM db20130101.logs_fts WHERE logs_fts MATCH ?)', clause)
+        self.assertIn('plugin_output : "disk ""full"""', values)
+        self.assertEqual(3, clause.count('?'))
+        self.assertEqual(3, len(values))
+
+    def test_sql_filter_plans(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        db.sql_filter_plans.clear()
+        # The same filter shapes give the same statement text, only the values differ
+        first = db.make_sql_filter('>=', 'time', '100')
+        second = db.make_sql_filter('>=', 'time', '200')
+        self.assertEqual(first.clause, second.clause)
+        self.assertEqual(['200'], second.values)
+        self.assertEqual(1, len(db.sql_filter_plans))
+        self.assertEqual(['host_name LIKE ?', ['%test%']], db.make_sql_filter('~', 'host_name', 'test')())
+        self.assertEqual(['host_name IS NULL', []], db.make_sql_filter('=', 'host_name', '')())
+        self.assertEqual(['1 = 1', []], db.make_sql_filter('=', 'current_host_name', 'test')())
+        self.assertEqual(4, len(db.sql_filter_plans))
+
+        # The queries of the same shape share the plan of the whole stack, only their values differ
+        stack = LiveStatusSqlStack()
+        clauses = []
+        for host_name, start in (('test_host_0', '100'), ('test_host_1', '200')):
+            stack.put_stack(db.make_sql_filter('>=', 'time', start))
+            stack.put_stack(db.make_sql_filter('=', 'host_name', host_name))
+            stack.put_stack(db.make_sql_filter('~', 'plugin_output', 'disk'))
+            stack.not_elements()
+            stack.or_elements(2)
+            clause, values = stack.get_filter()()
+            clauses.append(clause)
+            self.assertEqual(['%disk%', host_name, start], values)
+        self.assertEqual('(((NOT plugin_output LIKE ?) OR host_name = ?) AND time >= ?)', clauses[0])
+        self.assertEqual(clauses[0], clauses[1])
+        self.assertEqual(1, len(stack.plans))
+
+    def test_expire_archives(self):
+        self.print_header()
+        if os.path.exists("tmp/expire"):
+            shutil.rmtree("tmp/expire")
+        os.makedirs("tmp/expire/archives")
+        today = datetime.date.today()
+        for days in range(1, 11):
+            day = today - datetime.timedelta(days=days)
+            dbconn = sqlite3.connect("tmp/expire/archives/livelogs-%s.db" % day.strftime("%Y-%m-%d"))
+            dbconn.execute("CREATE TABLE logs (time INT)")
+            dbconn.close()
+        dbmodconf = Module({
+            'module_name': 'LogStore',
+            'module_type': 'logstore_sqlite',
+            'database_file': "tmp/expire/livelogs.db",
+            'archive_path': "tmp/expire/archives",
+            'expired_archives_path': "tmp/expire/cold",
+            'max_logs_age': '4',
+        })
+        db = LiveStatusLogStoreSqlite(dbmodconf)
+        db.open()
+        self.assertEqual(10, len(db.archive_starts))
+
+        # 6 expired archives, 4 per call
+        self.assertTrue(db.log_db_expire_archives(4))
+        self.assertEqual(6, len(db.archive_starts))
+        self.assertFalse(db.log_db_expire_archives(4))
+        self.assertEqual(4, len(db.archive_starts))
+        self.assertEqual(4, len(os.listdir("tmp/expire/archives")))
+        self.assertEqual(6, len([f for f in os.listdir("tmp/expire/cold") if f.endswith('.db.gz')]))
+        db.close()
+        shutil.rmtree("tmp/expire")
+
+    def test_compressed_archives(self):
+        self.print_header()
+        if os.path.exists("tmp/compress"):
+            shutil.rmtree("tmp/compress")
+        os.makedirs("tmp/compress/archives")
+        today = datetime.date.today()
+        for days in range(1, 6):
+            day = datetime.datetime(today.year, today.month, today.day) - datetime.timedelta(days=days)
+            dbconn = sqlite3.connect("tmp/compress/archives/livelogs-%s.db" % day.strftime("%Y-%m-%d"))
+            dbconn.execute("CREATE TABLE logs (logobject INT, attempt INT, class INT, command_name VARCHAR(64), "
+                           "comment VARCHAR(256), contact_name VARCHAR(64), host_name VARCHAR(64), lineno INT, "
+                           "message VARCHAR(512), options VARCHAR(512), plugin_output VARCHAR(256), "
+                           "service_description VARCHAR(64), state INT, state_type VARCHAR(10), time INT, "
+                           "type VARCHAR(64))")
+            dbconn.execute("INSERT INTO logs (host_name, time, class) VALUES ('test_host_0', ?, 1)",
+                           (int(time.mktime(day.timetuple())) + 3600,))
+            dbconn.commit()
+            dbconn.close()
+        # An archive compressed by an older version, without the indexes
+        oldest = "tmp/compress/archives/livelogs-%s.db" % day.strftime("%Y-%m-%d")
+        with open(oldest, 'rb') as source:
+            with gzip.open(oldest + '.gz', 'wb') as target:
+                shutil.copyfileobj(source, target)
+        os.remove(oldest)
+        dbmodconf = Module({
+            'module_name': 'LogStore',
+            'module_type': 'logstore_sqlite',
+            'database_file': "tmp/compress/livelogs.db",
+            'archive_path': "tmp/compress/archives",
+            'compress_archives_after': '2',
+            'compressed_cache_size': '0',
+            'max_logs_age': '7',
+        })
+        db = LiveStatusLogStoreSqlite(dbmodconf)
+        db.open()
+        db.prepare_log_db_table()
+        self.assertFalse(db.log_db_compress_archives())
+        self.assertEqual(3, len([f for f in os.listdir("tmp/compress/archives") if f.endswith('.db.gz')]))
+        self.assertEqual(5, len(db.archive_starts))
+
+        # Decompressed on demand, only the last one is kept
+        logs = list(db.get_live_data_log())
+        self.assertEqual(5, len(logs))
+        self.assertEqual(1, len(db.compressed_cache))
+
+        # The archives are upgraded before their compression, not the decompressed copies
+        def has_time_index():
+            dbconn = sqlite3.connect(list(db.compressed_cache.values())[0][0])
+            count = dbconn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'logs_time'").fetchone()[0]
+            dbconn.close()
+            return count == 1
+        self.assertTrue(has_time_index())
+        db.add_filter('<', 'time', str(int(time.mktime(day.timetuple())) + 86400))
+        self.assertEqual(1, len(list(db.get_live_data_log())))
+        self.assertFalse(has_time_index())
+        db.close()
+        shutil.rmtree("tmp/compress")
+
+    def test_attach_cache(self):
+        self.print_header()
+        if os.path.exists("tmp/attach"):
+            shutil.rmtree("tmp/attach")
+        os.makedirs("tmp/attach")
+        dbmodconf = Module({
+            'module_name': 'LogStore',
+            'module_type': 'logstore_sqlite',
+            'database_file': "tmp/attach/livelogs.db",
+            'archive_path': "tmp/attach/archives",
+            'attach_cache_size': '9',
+            'max_logs_age': '30',
+        })
+        db = LiveStatusLogStoreSqlite(dbmodconf)
+        db.open()
+        db.prepare_log_db_table()
+        today = int(time.mktime(datetime.date.today().timetuple()))
+        for day in range(1, 13):
+            for i in range(3):
+                db.manage_log_line("[%d] HOST ALERT: test_host_0;DOWN;HARD;1;Output %d %d"
+                                   % (today - day * 86400 + 3600 * i, day, i))
+        db.commit()
+        db.log_db_do_archive()
+        self.assertEqual(12, len(db.archive_starts))
+
+        # The least recently used archives are detached, the query reads the 12 archives
+        db.add_filter('>=', 'time', str(today - 12 * 86400))
+        self.assertEqual(36, len(list(db.get_live_data_log())))
+        self.assertEqual(9, len(db.attached_archives))
+
+        # A late log is moved to its archive while the cache is full
+        oldest = today - 12 * 86400
+        db.manage_log_line("[%d] HOST ALERT: test_host_0;DOWN;HARD;1;Late" % (oldest + 60))
+        db.commit()
+        db.log_db_do_archive()
+        self.assertEqual(0, db.execute("SELECT COUNT(*) FROM logs")[0][0])
+        self.assertEqual(9, len(db.attached_archives))
+        db.add_filter('>=', 'time', str(oldest))
+        db.add_filter('<', 'time', str(oldest + 86400))
+        self.assertEqual(4, len(list(db.get_live_data_log())))
+        db.add_filter('>=', 'time', str(oldest))
+        self.assertEqual(37, len(list(db.get_live_data_log())))
+        db.close()
+        shutil.rmtree("tmp/attach")
+
+    def test_archive_chunks(self):
+        self.print_header()
+        yesterday = int(time.mktime((datetime.date.today() - datetime.timedelta(days=1)).timetuple()))
+        expected = sorted(["Output %03d %s" % (i, 'x' * 200) for i in range(100)])
+
+        def stored(datafile):
+            dbconn = sqlite3.connect(datafile)
+            outputs = [row[0] for row in dbconn.execute("SELECT plugin_output FROM logs")]
+            dbconn.close()
+            return outputs
+
+        for vacuum_mode in ('full', 'incremental', 'none'):
+            if os.path.exists("tmp/chunks"):
+                shutil.rmtree("tmp/chunks")
+            os.makedirs("tmp/chunks")
+            dbmodconf = Module({
+                'module_name': 'LogStore',
+                'module_type': 'logstore_sqlite',
+                'database_file': "tmp/chunks/livelogs.db",
+                'archive_path': "tmp/chunks/archives",
+                'archive_chunk_size': '40',
+                'vacuum_mode': vacuum_mode,
+                'max_logs_age': '7',
+            })
+            db = LiveStatusLogStoreSqlite(dbmodconf)
+            db.open()
+            db.prepare_log_db_table()
+            for i in range(100):
+                db.manage_log_line("[%d] HOST ALERT: test_host_0;DOWN;HARD;1;Output %03d %s"
+                                   % (yesterday + 60 * i, i, 'x' * 200))
+            db.commit()
+            archive = db.log_db_archive_day(datetime.datetime.fromtimestamp(yesterday))[2]
+
+            # The broker stops after the first chunk: each log is either in the current datafile or in the archive
+            db.log_db_start_archive()
+            self.assertTrue(db.log_db_archive_step(db.archive_chunk_size))
+            db.close()
+            self.assertEqual(40, len(stored(archive)))
+            self.assertEqual(expected, sorted(stored("tmp/chunks/livelogs.db") + stored(archive)))
+
+            # The next archive job moves the other chunks
+            db = LiveStatusLogStoreSqlite(dbmodconf)
+            db.open()
+            db.prepare_log_db_table()
+            db.add_filter('>=', 'time', str(yesterday))
+            self.assertEqual(expected, sorted([row.plugin_output for row in db.get_live_data_log()]))
+            db.log_db_start_archive()
+            steps = 0
+            while db.log_db_archive_step(db.archive_chunk_size):
+                steps += 1
+            self.assertEqual(1, steps)
+            self.assertEqual([], stored("tmp/chunks/livelogs.db"))
+            self.assertEqual(expected, sorted(stored(archive)))
+            if vacuum_mode != 'none':
+                # The pages of the moved logs are freed
+                self.assertEqual(0, db.dbconn.execute("PRAGMA freelist_count").fetchone()[0])
+            db.close()
+        shutil.rmtree("tmp/chunks")
+
+    def test_writer_thread(self):
+        self.print_header()
+        if os.path.exists("tmp/writer"):
+            shutil.rmtree("tmp/writer")
+        os.makedirs("tmp/writer")
+        dbmodconf = Module({
+            'module_name': 'LogStore',
+            'module_type': 'logstore_sqlite',
+            'database_file': "tmp/writer/livelogs.db",
+            'archive_path': "tmp/writer/archives",
+        })
+        now = int(time.time())
+        lines = ["[%d] HOST ALERT: test_host_0;DOWN;HARD;1;Output %d" % (now, i) for i in range(5)]
+        gate = threading.Event()
+
+        class GatedWriter(LiveStatusLogStoreWriter):
+            # The queue fills up until the gate is opened
+            def run(self):
+                gate.wait()
+                LiveStatusLogStoreWriter.run(self)
+
+        def stored_outputs():
+            dbconn = sqlite3.connect("tmp/writer/livelogs.db")
+            outputs = [row[0] for row in dbconn.execute("SELECT plugin_output FROM logs ORDER BY rowid")]
+            dbconn.execute("DELETE FROM logs")
+            dbconn.commit()
+            dbconn.close()
+            return outputs
+
+        # The oldest lines are dropped, the stop stores the queued lines
+        gate.clear()
+        writer = GatedWriter(dbmodconf, 2, 'drop_oldest', "tmp/writer/spill")
+        writer.start()
+        for line in lines:
+            writer.put(line)
+        self.assertEqual({'queue_depth': 2, 'queue_max_depth': 2, 'queue_size': 2, 'queued': 5, 'dropped': 3,
+                          'spilled': 0, 'written': 0}, writer.get_stats())
+        gate.set()
+        writer.stop()
+        self.assertEqual(2, writer.get_stats()['written'])
+        self.assertEqual(['Output 3', 'Output 4'], stored_outputs())
+
+        # The spilled lines and the next ones are stored in order
+        gate.clear()
+        writer = GatedWriter(dbmodconf, 2, 'spill', "tmp/writer/spill")
+        writer.start()
+        for line in lines:
+            writer.put(line)
+        self.assertEqual(3, writer.get_stats()['spilled'])
+        gate.set()
+        writer.stop()
+        self.assertEqual(5, writer.get_stats()['written'])
+        self.assertFalse(os.path.exists("tmp/writer/spill"))
+        self.assertEqual(['Output %d' % i for i in range(5)], stored_outputs())
+
+        # The lines which come during a replay are spilled until the spill file is drained
+        late = ["[%d] HOST ALERT: test_host_0;UP;HARD;1;Late" % now]
+
+        class ReplayingWriter(GatedWriter):
+            # A line comes while the first spilled line is replayed
+            def replay_spill_file(self):
+                manage_log_line = self.store.manage_log_line
+
+                def manage_and_put(line):
+                    manage_log_line(line)
+                    if late:
+                        self.put(late.pop())
+                self.store.manage_log_line = manage_and_put
+                LiveStatusLogStoreWriter.replay_spill_file(self)
+                self.store.manage_log_line = manage_log_line
+
+        gate.clear()
+        writer = ReplayingWriter(dbmodconf, 2, 'spill', "tmp/writer/spill")
+        writer.start()
+        for line in lines:
+            writer.put(line)
+        gate.set()
+        writer.stop()
+        self.assertEqual(4, writer.get_stats()['spilled'])
+        self.assertEqual(6, writer.get_stats()['written'])
+        self.assertFalse(writer.spilling)
+        self.assertEqual(['Output %d' % i for i in range(5)] + ['Late'], stored_outputs())
+
+        # The broker waits for some room in the queue
+        gate.clear()
+        writer = GatedWriter(dbmodconf, 1, 'block', "tmp/writer/spill")
+        writer.start()
+        threading.Timer(0.5, gate.set).start()
+        for line in lines:
+            writer.put(line)
+        writer.stop()
+        self.assertEqual(1, writer.get_stats()['queue_max_depth'])
+        self.assertEqual(5, writer.get_stats()['written'])
+        self.assertEqual(['Output %d' % i for i in range(5)], stored_outputs())
+
+        # The database can not be opened: the lines are dropped, the broker is not blocked
+        writer = LiveStatusLogStoreWriter(Module({
+            'module_name': 'LogStore',
+            'module_type': 'logstore_sqlite',
+            'database_file': "tmp/writer/missing/livelogs.db",
+            'archive_path': "tmp/writer/archives",
+        }), 1, 'block', "tmp/writer/spill")
+        writer.start()
+        writer.join()
+        for line in lines:
+            writer.put(line)
+        writer.stop()
+        self.assertEqual(5, writer.get_stats()['dropped'])
+        shutil.rmtree("tmp/writer")
+
+    def test_compact_storage_schema(self):
+        self.print_header()
+        if os.path.exists("tmp/compact"):
+            shutil.rmtree("tmp/compact")
+        os.makedirs("tmp/compact")
+        conf = {
+            'module_name': 'LogStore',
+            'module_type': 'logstore_sqlite',
+            'database_file': "tmp/compact/livelogs.db",
+            'archive_path': "tmp/compact/archives",
+            'max_logs_age': '7',
+        }
+        now = int(time.time())
+        query = "SELECT host_name, service_description, state_type, type, plugin_output FROM logs ORDER BY time"
+        db = LiveStatusLogStoreSqlite(Module(conf))
+        db.open()
+        db.prepare_log_db_table()
+        for i in range(10):
+            db.manage_log_line("[%d] SERVICE ALERT: test_host_0;test_ok_%d;CRITICAL;HARD;1;Failure %d"
+                               % (now - 10 + i, i % 2, i))
+        db.commit()
+        self.assertEqual('logs', db.logs_data_table)
+        plain = db.execute(query)
+        db.close()
+
+        # Migration of the plain database
+        conf['storage_schema'] = 'compact'
+        db = LiveStatusLogStoreSqlite(Module(conf))
+        db.open()
+        db.prepare_log_db_table()
+        self.assertEqual('logs_data', db.logs_data_table)
+        self.assertEqual(plain, db.execute(query))
+
+        # The new logs are encoded with the same dictionary
+        db.manage_log_line("[%d] SERVICE ALERT: test_host_0;test_ok_0;OK;HARD;1;Ok" % now)
+        db.commit()
+        self.assertEqual(11, db.execute("SELECT COUNT(*) FROM logs WHERE host_name = 'test_host_0'")[0][0])
+        self.assertEqual(5, db.execute("SELECT COUNT(*) FROM logs_dict")[0][0])
+        db.close()
+        shutil.rmtree("tmp/compact")
+
+    def test_set_columns(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        now = int(time.time())
+        db.manage_log_line("[%d] SERVICE ALERT: test_host_0;test_ok_0;CRITICAL;HARD;1;Failure" % (now - 1))
+        db.commit()
+
+        # Only the requested and the filter columns are read, the others are None
+        db.set_columns(['time', 'host_name'], ['state'])
+        db.add_filter('>=', 'time', str(now - 10))
+        rows = list(db.get_live_data_log())
+        self.assertEqual(1, len(rows))
+        self.assertEqual('test_host_0', rows[0].host_name)
+        self.assertEqual(2, rows[0].state)
+        self.assertEqual(None, rows[0].plugin_output)
+        self.assertEqual(None, rows[0].message)
+
+        # The current_* columns need the names used to fill the log lines
+        db.set_columns(['time', 'current_service_state'])
+        db.add_filter('>=', 'time', str(now - 10))
+        rows = list(db.get_live_data_log())
+        self.assertEqual('test_ok_0', rows[0].service_description)
+        self.assertEqual(None, rows[0].plugin_output)
+
+        # The projection is reset after each query
+        db.add_filter('>=', 'time', str(now - 10))
+        rows = list(db.get_live_data_log())
+        self.assertEqual('Failure', rows[0].plugin_output)
+
+    def test_set_limit(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        use_aggressive_sql = db.use_aggressive_sql
+        db.use_aggressive_sql = True
+        now = int(time.time())
+        for i in range(10):
+            db.manage_log_line("[%d] SERVICE ALERT: test_host_0;test_ok_0;CRITICAL;HARD;1;Failure %d"
+                               % (now - 10 + i, i))
+        db.commit()
+
+        # The newest rows of an exact filter
+        db.set_limit(3, newest_first=True)
+        db.add_filter('>=', 'time', str(now - 10))
+        db.add_filter('=', 'host_name', 'test_host_0')
+        rows = list(db.get_live_data_log())
+        self.assertEqual([now - 1, now - 2, now - 3], [row.time for row in rows])
+
+        # The python filters may drop some rows of a substring match, no limit
+        db.set_limit(3, newest_first=True)
+        db.add_filter('>=', 'time', str(now - 10))
+        db.add_filter('~', 'host_name', 'host_0')
+        rows = list(db.get_live_data_log())
+        self.assertEqual(10, len(rows))
+        self.assertEqual(now - 1, rows[0].time)
+        db.use_aggressive_sql = use_aggressive_sql
+
+    def test_stats(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        use_aggressive_sql = db.use_aggressive_sql
+        db.use_aggressive_sql = True
+        now = int(time.time())
+        for i in range(10):
+            db.manage_log_line("[%d] SERVICE ALERT: test_host_0;test_ok_%d;CRITICAL;HARD;1;Failure"
+                               % (now - 10 + i, i % 2))
+        db.commit()
+
+        db.add_filter('>=', 'time', str(now - 10))
+        db.add_filter('=', 'type', 'SERVICE ALERT')
+        stats = db.get_live_data_log_stats([('count', None), ('min', 'time'), ('max', 'time')],
+                                           ['service_description'])
+        self.assertEqual([('test_ok_0', 5, now - 10, now - 2), ('test_ok_1', 5, now - 9, now - 1)], stats)
+
+        db.add_filter('=', 'host_name', 'unknown')
+        self.assertEqual([(0, None)], db.get_live_data_log_stats([('count', None), ('max', 'time')]))
+
+        # The python filters are needed, the filter is left for get_live_data_log
+        db.add_filter('~', 'host_name', 'host_0')
+        self.assertEqual(None, db.get_live_data_log_stats([('count', None)]))
+        self.assertEqual(10, len(list(db.get_live_data_log())))
+
+        # The projection and the limit of a stats query are not left for the next query
+        db.set_columns(['time'])
+        db.set_limit(1)
+        db.add_filter('>=', 'time', str(now - 10))
+        self.assertEqual([(10,)], db.get_live_data_log_stats([('count', None)]))
+        db.add_filter('>=', 'time', str(now - 10))
+        rows = list(db.get_live_data_log())
+        self.assertEqual(10, len(rows))
+        self.assertEqual('Failure', rows[0].plugin_output)
+        db.use_aggressive_sql = use_aggressive_sql
+
+    def test_rollups(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        today = datetime.date.today()
+        yesterday = int(time.mktime((today - datetime.timedelta(days=1)).timetuple()))
+        for i, state in enumerate(('CRITICAL', 'OK', 'WARNING')):
+            db.manage_log_line("[%d] SERVICE ALERT: test_host_0;test_ok_0;%s;HARD;1;Output"
+                               % (yesterday + 3600 * (i + 1), state))
+        db.manage_log_line("[%d] HOST ALERT: test_host_0;DOWN;HARD;1;Output" % (yesterday + 3600))
+        db.commit()
+        db.log_db_do_archive()
+
+        # The rollups of yesterday are read from its archive
+        archive = db.log_db_archive_day(datetime.datetime.fromtimestamp(yesterday))[2]
+        self.assertTrue(os.path.exists(archive))
+        con = sqlite3.connect(archive)
+        self.assertEqual(2, con.execute("SELECT COUNT(*) FROM logs_day_counts").fetchone()[0])
+        con.close()
+        counts = db.get_log_rollups('counts', yesterday, yesterday + 3600)
+        self.assertEqual([(yesterday, 1, 'HOST ALERT', 1), (yesterday, 1, 'SERVICE ALERT', 3)], sorted(counts))
+        states = db.get_log_rollups('states', yesterday, yesterday + 3600)
+        self.assertEqual([(yesterday, 'test_host_0', None, 1, yesterday + 3600, 1, yesterday + 3600, 1),
+                          (yesterday, 'test_host_0', 'test_ok_0', 3, yesterday + 3600, 2, yesterday + 10800, 1)],
+                         sorted(states))
+
+    def test_metrics(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        self.assertEqual({}, db.get_metrics())
+        db.metrics = LiveStatusLogStoreMetrics()
+        yesterday = int(time.mktime((datetime.date.today() - datetime.timedelta(days=1)).timetuple()))
+        for i in range(5):
+            db.manage_log_line("[%d] SERVICE ALERT: test_host_0;test_ok_0;CRITICAL;HARD;1;Failure %d"
+                               % (yesterday + 60 * i, i))
+        db.commit()
+        db.log_db_do_archive()
+        db.add_filter('>=', 'time', str(yesterday))
+        self.assertEqual(5, len(list(db.get_live_data_log())))
+
+        metrics = db.get_metrics()
+        self.assertEqual(5, metrics['counters']['rows_inserted'])
+        self.assertEqual(5, metrics['counters']['rows_archived'])
+        self.assertEqual(1, metrics['counters']['queries'])
+        # select() also counts the rows of the statements of the store, like the archive
+        self.assertTrue(metrics['counters']['rows_selected'] >= 5)
+        self.assertEqual(5, metrics['counters']['rows_yielded'])
+        self.assertEqual(1, metrics['counters']['archives_queried'])
+        for name in ('insert', 'commit', 'archive', 'attach', 'sql', 'row_factory', 'query', 'query_consumer'):
+            self.assertTrue(metrics['histograms'][name]['count'] > 0)
+        self.assertEqual(1, sum([count for _, count in metrics['histograms']['query']['buckets']]))
+        db.log_metrics()
+        db.metrics = None
+
+    def test_result_cache(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        db.result_cache = LiveStatusLogResultCache(10, 1024 * 1024)
+        yesterday = int(time.mktime((datetime.date.today() - datetime.timedelta(days=1)).timetuple()))
+        for i in range(5):
+            db.manage_log_line("[%d] SERVICE ALERT: test_host_0;test_ok_0;CRITICAL;HARD;1;Failure %d"
+                               % (yesterday + 60 * i, i))
+        db.commit()
+        db.log_db_do_archive()
+
+        db.add_filter('>=', 'time', str(yesterday))
+        db.add_filter('=', 'host_name', 'test_host_0')
+        rows = [row.as_tuple() for row in db.get_live_data_log()]
+        self.assertEqual(5, len(rows))
+        self.assertEqual(1, len(db.result_cache.entries))
+
+        # The same query is read from the cache, the archive is not attached
+        attach_archive = db.attach_archive
+        db.attach_archive = None
+        db.add_filter('>=', 'time', str(yesterday))
+        db.add_filter('=', 'host_name', 'test_host_0')
+        self.assertEqual(rows, [row.as_tuple() for row in db.get_live_data_log()])
+        # The time bounds which cover the whole archive are not in the key of the cached rows
+        db.add_filter('>=', 'time', str(yesterday - 3600))
+        db.add_filter('<', 'time', str(yesterday + 2 * 86400))
+        db.add_filter('=', 'host_name', 'test_host_0')
+        self.assertEqual(rows, [row.as_tuple() for row in db.get_live_data_log()])
+        self.assertEqual(1, len(db.result_cache.entries))
+        db.attach_archive = attach_archive
+        db.add_filter('>=', 'time', str(yesterday + 60))
+        db.add_filter('=', 'host_name', 'test_host_0')
+        self.assertEqual(rows[1:], [row.as_tuple() for row in db.get_live_data_log()])
+        self.assertEqual(2, len(db.result_cache.entries))
+
+        # A late log modifies the archive
+        time.sleep(1)
+        db.manage_log_line("[%d] SERVICE ALERT: test_host_0;test_ok_0;OK;HARD;1;Late" % (yesterday + 600))
+        db.commit()
+        db.log_db_do_archive()
+        db.add_filter('>=', 'time', str(yesterday))
+        db.add_filter('=', 'host_name', 'test_host_0')
+        self.assertEqual(6, len(list(db.get_live_data_log())))
+        db.result_cache = None
+
+    def test_query_workers(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        today = int(time.mktime(datetime.date.today().timetuple()))
+        for day in range(1, 5):
+            for i in range(10):
+                db.manage_log_line("[%d] SERVICE ALERT: test_host_0;test_ok_0;CRITICAL;HARD;1;Failure %d"
+                                   % (today - day * 86400 + 60 * i, i))
+        db.commit()
+        db.log_db_do_archive()
+        cursor_arraysize = db.CURSOR_ARRAYSIZE
+        db.CURSOR_ARRAYSIZE = 3
+
+        def query():
+            db.add_filter('>=', 'time', str(today - 4 * 86400))
+            db.add_filter('<', 'time', str(today))
+            return db.get_live_data_log()
+
+        # The archives queried by the pool give the rows of the serial path, in the same order
+        serial = [row.as_tuple() for row in query()]
+        self.assertEqual(40, len(serial))
+        db.query_workers = 2
+        db.query_prefetch = 1
+        self.assertEqual(serial, [row.as_tuple() for row in query()])
+        self.assertEqual(2, len(db.query_threads))
+
+        # A query stopped early does not block the workers
+        rows = query()
+        next(rows)
+        rows.close()
+        self.assertEqual(serial, [row.as_tuple() for row in query()])
+
+        # The error of a worker is raised by the query
+        def failing_row_factory(cursor, row):
+            raise ValueError("bad row")
+        make_row_factory = db.make_row_factory
+        db.make_row_factory = lambda: failing_row_factory
+        self.assertRaises(LiveStatusLogStoreError, list, query())
+        db.make_row_factory = make_row_factory
+        self.assertEqual(serial, [row.as_tuple() for row in query()])
+
+        db.stop_query_workers()
+        db.query_workers = 0
+        db.CURSOR_ARRAYSIZE = cursor_arraysize
+
+    def test_states_at(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        today = int(time.mktime(datetime.date.today().timetuple()))
+        yesterday = int(time.mktime((datetime.date.today() - datetime.timedelta(days=1)).timetuple()))
+        db.manage_log_line("[%d] SERVICE ALERT: test_host_0;test_ok_0;CRITICAL;HARD;1;Output" % (yesterday + 3600))
+        db.manage_log_line("[%d] SERVICE ALERT: test_host_0;test_ok_0;WARNING;HARD;1;Output" % (yesterday + 7200))
+        db.manage_log_line("[%d] HOST ALERT: test_host_0;DOWN;HARD;1;Output" % (yesterday + 3600))
+        db.manage_log_line("[%d] SERVICE ALERT: test_host_0;test_ok_0;OK;HARD;1;Output" % (today + 1))
+        db.commit()
+        db.log_db_do_archive()
+
+        # Yesterday is read from the snapshots
+        self.assertEqual(2, db.execute("SELECT COUNT(*) FROM logs_snapshots WHERE day = %d" % yesterday)[0][0])
+        self.assertEqual({('test_host_0', None): (yesterday + 3600, 1),
+                          ('test_host_0', 'test_ok_0'): (yesterday + 7200, 1)}, db.get_log_states_at(today))
+        # Today is read from the logs until the time
+        self.assertEqual((today + 1, 0), db.get_log_states_at(today + 2)[('test_host_0', 'test_ok_0')])
+        # The logs of the day of the time
+        self.assertEqual({('test_host_0', None): (yesterday + 3600, 1),
+                          ('test_host_0', 'test_ok_0'): (yesterday + 3600, 2)}, db.get_log_states_at(yesterday + 3601))
+
+        # The archives of a previous version have neither rollups nor snapshots
+        archive = sqlite3.connect(db.log_db_archive_day(datetime.date.fromtimestamp(yesterday))[2])
+        archive.execute("DROP TABLE logs_day_states")
+        archive.commit()
+        archive.close()
+        db.execute("DROP TABLE logs_snapshots")
+        db.execute("DROP TABLE logs_snapshots_days")
+        states = {('test_host_0', None): (yesterday + 3600, 1), ('test_host_0', 'test_ok_0'): (yesterday + 7200, 1)}
+        # A read only database scans the archives
+        db.read_only = True
+        self.assertEqual(states, db.get_log_states_at(today))
+        self.assertEqual([], db.execute("SELECT name FROM sqlite_master WHERE name='logs_snapshots'"))
+        # Else their snapshots are built once
+        db.read_only = False
+        self.assertEqual(states, db.get_log_states_at(today))
+        self.assertEqual(2, db.execute("SELECT COUNT(*) FROM logs_snapshots WHERE day = %d" % yesterday)[0][0])
+        self.assertEqual([(yesterday,)], db.execute("SELECT day FROM logs_snapshots_days"))
+        self.assertEqual([], db.log_db_missing_snapshots(today))
+
+    def test_partitions(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        db.partition_hours = 6
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        start = int(time.mktime(yesterday.timetuple()))
+        for hour in range(0, 24, 3):
+            db.manage_log_line("[%d] HOST ALERT: test_host_0;DOWN;HARD;1;Output %d" % (start + hour * 3600, hour))
+        db.commit()
+        db.log_db_do_archive()
+
+        # Each partition of yesterday has its own archive
+        for hour in range(0, 24, 6):
+            archive = db.log_db_archive_day(yesterday, hour)[2]
+            self.assertTrue(os.path.exists(archive))
+            db.execute("ATTACH DATABASE '%s' AS partition" % archive)
+            self.assertEqual(2, db.execute("SELECT COUNT(*) FROM partition.logs")[0][0])
+            db.execute("DETACH DATABASE partition")
+        self.assertEqual(0, db.execute("SELECT COUNT(*) FROM logs WHERE time < %d" % (start + 86400))[0][0])
+        # A query only opens the partitions of its time range
+        self.assertEqual(["db%s06" % yesterday.strftime("%Y%m%d")],
+                         [f[1] for f in db.log_db_relevant_files(start + 7 * 3600, start + 11 * 3600)])
+        request = """GET log
+        Filter: time >= %d
+        Filter: time < %d
+        Columns: time plugin_output
+        OutputFormat: python""" % (start, start + 86400)
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual(8, len(eval(response)))
+
+        # A late log archived without partitions goes to the archive of the whole day,
+        # which overlaps the partitions: every datafile stays indexed and queried
+        db.partition_hours = 0
+        db.manage_log_line("[%d] HOST ALERT: test_host_0;UP;HARD;1;Output late" % (start + 3600))
+        db.commit()
+        db.log_db_do_archive()
+        self.assertTrue(os.path.exists(db.log_db_archive_day(yesterday)[2]))
+        self.assertEqual(5, len(db.archive_starts))
+        db.log_db_build_archive_index()
+        self.assertEqual(5, len(db.archive_starts))
+        self.assertEqual(2, len(db.log_db_relevant_files(start, start + 2 * 3600)))
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual(9, len(eval(response)))
+
+    def test_not_rotated(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        yesterday = int(time.mktime((datetime.date.today() - datetime.timedelta(days=1)).timetuple()))
+        for hour in range(3):
+            db.manage_log_line("[%d] HOST ALERT: test_host_0;DOWN;HARD;1;Output %d" % (yesterday + hour * 3600, hour))
+        db.commit()
+
+        # The previous day is still in the current datafile until the rotation
+        self.assertEqual([], db.archive_days)
+        self.assertEqual([("main", yesterday)],
+                         [(f[1], f[3]) for f in db.log_db_relevant_files(yesterday, yesterday + 7200)])
+        db.add_filter('>=', 'time', str(yesterday))
+        db.add_filter('<', 'time', str(yesterday + 7200))
+        self.assertEqual(2, len(list(db.get_live_data_log())))
+        db.log_db_do_archive()
+        self.assertEqual(["db%s" % datetime.date.fromtimestamp(yesterday).strftime("%Y%m%d")],
+                         [f[1] for f in db.log_db_relevant_files(yesterday, yesterday + 7200)])
+
+    def test_bulk_load(self):
+        self.print_header()
+        db = self.livestatus_broker.db
+        yesterday = int(time.mktime((datetime.date.today() - datetime.timedelta(days=1)).timetuple()))
+        log_files = []
+        for number in range(2):
+            log_file = os.path.join(os.path.dirname(db.database_file), 'nagios-%d.log' % number)
+            with open(log_file, 'w') as log:
+                for minute in range(10):
+                    log.write("[%d] HOST ALERT: test_host_0;DOWN;HARD;1;Output %d\n"
+                              % (yesterday + number * 3600 + minute * 60, minute))
+                log.write("[%d] Info: ignored\n" % yesterday)
+            log_files.append(log_file)
+
+        self.assertEqual(20, db.log_db_bulk_load(log_files, processes=2))
+        for log_file in log_files:
+            os.remove(log_file)
+        # The logs of yesterday are in its archive, with the indexes and the rollups
+        archive = db.log_db_archive_day(datetime.datetime.fromtimestamp(yesterday))[2]
+        self.assertTrue(os.path.exists(archive))
+        db.execute("ATTACH DATABASE '%s' AS loaded" % archive)
+        self.assertEqual(20, db.execute("SELECT COUNT(*) FROM loaded.logs")[0][0])
+        self.assertEqual(1, db.execute("SELECT COUNT(*) FROM loaded.sqlite_master WHERE name = 'logs_time'")[0][0])
+        self.assertEqual([(1, 'HOST ALERT', 20)], db.execute("SELECT * FROM loaded.logs_day_counts"))
+        db.execute("DETACH DATABASE loaded")
+        request = """GET log
+        Filter: time >= %d
+        Filter: time < %d
+        Columns: time plugin_output
+        OutputFormat: python""" % (yesterday, yesterday + 86400)
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        self.assertEqual(20, len(eval(response)))
+
+    def test_light_rows(self):
+        self.print_header()
+        host = self.sched.hosts.find_by_name("test_host_0")
+        now = time.time()
+        for state, output in (('DOWN', 'i am down'), ('UP', 'i am up')):
+            host.state = state
+            host.state_type = 'HARD'
+            host.attempt = 1
+            host.output = output
+            host.raise_alert_log_entry()
+            time.sleep(60)
+        self.update_broker()
+        request = """GET log
+        Filter: time >= """ + str(int(now - 60)) + """
+        Filter: host_name = test_host_0
+        Filter: state = 1
+        Columns: time type state host_name plugin_output current_host_name current_host_state
+        OutputFormat: python"""
+        db = self.livestatus_broker.db
+        response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        db.light_rows = True
+        light_response, keepalive = self.livestatus_broker.livestatus.handle_request(request)
+        db.light_rows = False
+        self.assertEqual(response, light_response)
+        self.assertEqual(1, len(eval(light_response)))
+
+        # The full Logline is only built for the attributes which are not columns,
+        # select() yields the rows by chunks
+        query = "SELECT * FROM logs WHERE host_name = 'test_host_0' AND state = 1"
+        row = list(db.select(query, (), LiveStatusLogRowFactory()))[0][0]
+        logline = list(db.select(query, (), row_factory))[0][0]
+        self.assertFalse(isinstance(row, Logline))
+        self.assertTrue(isinstance(logline, Logline))
+        for attribute in ('time', 'type', 'state', 'host_name', 'plugin_output', 'logclass', 'lineno'):
+            self.assertEqual(getattr(logline, attribute), getattr(row, attribute))
+        self.assertEqual(logline.as_tuple(), row.get_logline().as_tuple())
+
     def test_archives_path(self):
         # os.removedirs("var/archives")
         self.print_header()
@@ -715,6 +1644,36 @@ ResponseHeader: fixed16
         self.assertEqual('XxX', livestatus_broker.max_logs_age)
         # A warning log is raised!
 
+    def test_performance_profile(self):
+        # default
+        db_module_conf = Module({
+            'module_name': 'LogStore',
+            'module_type': 'logstore_sqlite',
+            'database_file': 'livelogs',
+        })
+
+        livestatus_broker = LiveStatusLogStoreSqlite(db_module_conf)
+        self.assertEqual('durable', livestatus_broker.performance_profile)
+        self.assertEqual('truncate', livestatus_broker.journal_mode)
+        self.assertEqual({'synchronous': 'FULL'}, livestatus_broker.pragmas)
+
+        # preset with overridden pragmas
+        db_module_conf = Module({
+            'module_name': 'LogStore',
+            'module_type': 'logstore_sqlite',
+            'database_file': 'livelogs',
+            'performance_profile': 'fast',
+            'journal_mode': 'truncate',
+            'pragma_cache_size': '-8000',
+            'pragma_synchronous': 'OFF; DROP TABLE logs'
+        })
+
+        livestatus_broker = LiveStatusLogStoreSqlite(db_module_conf)
+        self.assertEqual('truncate', livestatus_broker.journal_mode)
+        self.assertEqual('-8000', livestatus_broker.pragmas['cache_size'])
+        # Invalid value, ignored
+        self.assertEqual('NORMAL', livestatus_broker.pragmas['synchronous'])
+
 
 @mock_livestatus_handle_request
 class TestConfigBig(TestConfig):